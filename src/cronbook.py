@@ -9,42 +9,79 @@
 # programs.
 # ------------------------------------------------------------------------------
 
-# dependencies
-from collections import OrderedDict
-import argparse
-import csv
-from datetime import datetime
-import json
+# dependencies, other modules are imported by the functions which use them so that each 
+# command only pays for the modules it needs
+import errno
 import os
+import re
 import sys
+import thread
 import time
-import traceback
-import urllib2
 
 # globals
+g_compact_rows = 100000
+g_compress_extensions = ['.gz', '.bz2']
+g_compress_size = 1048576
+g_daemon_open_max = 256
+g_daemon_socket = '/home/mylogin/log/cronbook_socket'
+g_daemon_timeout = 30
 g_file_delimiter = '|'
+g_file_dialect = 'cronbook'
 g_file_escapechar = '\\'
-g_file_escapechars = OrderedDict({
+g_file_escapechars = {
     '\b' : '\\b',
     '\e' : '\\e',
     '\f' : '\\f',
     '\n' : '\\n',
     '\r' : '\\r',
     '\t' : '\\t'
-})
+}
 g_file_extension = ''
 g_file_line_terminator = '\n'
 g_file_quotechar = '"'
-g_file_quoting = csv.QUOTE_NONE
+g_file_quoting = 3 # csv.QUOTE_NONE
 g_file_path_root = '/home/mylogin/log/'
-g_file_temporary = '/home/mylogin/log/tmp'
 g_http_proxies = {}
 g_http_url_add = '/cronbook_add'
+g_http_url_add_bulk = '/cronbook_add_bulk'
+g_index = True
+g_index_extension = '.idx'
+g_index_size = 65536
 g_key_name_timestamp = 'timestamp'
 g_key_name_unixtime = 'unixtime'
+g_log_flush_interval = 1 # seconds
+g_log_queue_size = 10000
+g_log_rotate_max = 5
+g_log_size = 1048576
+g_log_timeout = 0.1 # seconds a message waits for room in a full log queue before it is dropped
+g_manifest_extension = '.manifest'
+g_query_seek = True
+g_retention_age = 0 # seconds
+g_retention_budget = 0 # bytes, for all data sets
+g_retention_interval = 60
+g_retention_stamp = '.retention'
 g_rotate = True
+g_rotate_compress = '' # or '.gz', '.bz2'
+g_rotate_interval = 0 # seconds, e.g. 3600 for hourly or 86400 for daily files
 g_rotate_max = 10
+g_rotate_policies = {} # per data set, e.g. { 'mpstat' : { 'age' : 2592000, 'interval' : 86400, 'size' : 0 } }
+g_rotate_rows = 0
 g_rotate_size = 1048576
+g_schema_evolution = 'pad' # or 'segment'
+g_schema_reserve = 256
+g_schema_shift_size = 1048576
+g_timestamp_cache_size = 4096
+
+# caches
+g_dataset_locks = None # per data set write locks, {} when threads of one process write
+g_log = None # queue, thread, file name and dropped message count of the log writer
+g_re_values_clean = None
+g_re_values_special = None
+g_timestamp_cache = None
+g_timestamp_cache_last = (None, '') # replaced whole, so that threads never read half of it
+g_timestamp_cache_lock = thread.allocate_lock()
+g_timestamp_zone = ''
+g_timestamp_zone_expiry = 0
 
 # exception classes
 class Error(Exception):
@@ -87,6 +124,7 @@ class DiskError(Error):
     """Error for storage i/o"""
 
     def __init__(self, fname):
+        import traceback
         self.stack_trace = traceback.format_exc()
         self.expression = fname
         self.description = 'file open or permission error on \'' + self.expression + '\''
@@ -95,14 +133,24 @@ class NetworkError(Error):
     """Error for network i/o"""
 
     def __init__(self, url):
+        import traceback
         self.stack_trace = traceback.format_exc()
         self.expression = url
         self.description = 'network error on \'' + self.expression + '\''
 
+class DaemonError(Error):
+    """Error reported by the ingest daemon"""
+
+    def __init__(self, description):
+        self.stack_trace = ""
+        self.expression = g_daemon_socket
+        self.description = description
+
 class UploadError(Error):
     """Error for upload"""
 
     def __init__(self, response):
+        import traceback
         self.stack_trace = traceback.format_exc()
         self.expression = response
         self.description = 'upload error while communicating with server, error \'' + self.expression + '\''
@@ -110,17 +158,194 @@ class UploadError(Error):
 
 # Dataset oriented functions
 
+def ds_append ( f, schema, keys, values ):
+    """Writes a list to a data set with a known schema.  Returns number of rows and the schema after writing"""
+ 
+    from cStringIO import StringIO
+    csv = util_csv()
+
+    # keys do not have to be ordered, but are assumed to contain time; appends share the lock of the data set file,
+    # so that they only wait for schema changes and rotations, which take it exclusively
+    new_keys = util_key_new(schema, keys)
+    total_new_keys = len(new_keys)
+    ds_lock(f, (total_new_keys > 0))
+    try:
+        if (total_new_keys > 0) and (g_schema_evolution == 'segment'):
+            # continue in a new file with the widened schema, moving the open file over to it
+            schema = ds_schema_read(f)
+            schema = schema + util_key_new(schema, new_keys)
+            ds_segment_new(f, schema)
+        elif (total_new_keys > 0):
+            ds_schema_modify(f, new_keys)
+            schema = ds_schema_read(f)
+
+        # serialize all rows with one writer, then append them in a single write, which is not interleaved with
+        # appends of other processes as data set files are opened for appending
+        b = StringIO()
+        w = csv.writer(b, dialect=g_file_dialect)
+        order = util_values_mapper(schema, keys)
+        w.writerows(util_values_clean(order(row)) for row in values)
+        n = len(values)
+        try:
+            f.seek(0, 2)
+            util_write(f.fileno(), b.getvalue())
+        except:
+            raise DiskError(f.name)
+        if g_index:
+            ds_index_update(f, False)
+    finally:
+        ds_unlock(f)
+    return n, schema
+
+def ds_compact ( fname, size, unique ):
+    """Replaces the rotated files of a data set file by files of up to size bytes with all their rows sorted by unix time.  Returns number of rows"""
+
+    import heapq
+    csv = util_csv()
+
+    # an external merge sort: runs of g_compact_rows rows are sorted in memory and written to temporary files, which
+    # are then merged; sorting on whole rows after unix time places exact duplicates next to each other
+    entries = ds_manifest_read(fname)
+    suffixes = [x[0] for x in entries]
+    temporary = []
+    try:
+        schema = []
+        for x in suffixes:
+            t = ds_segment_open(fname + '.' + x)[1]
+            if t is not None:
+                schema += util_key_new(schema, ds_schema_read(t))
+                t.close()
+
+        run = []
+        rows = ds_segment_rows(fname, suffixes, schema)
+        while True:
+            row = next(rows, None)
+            if (row is not None):
+                run.append((long(row[0]), row))
+            if run and ((row is None) or (len(run) >= g_compact_rows)):
+                run.sort()
+                temporary.append(fname + '.compact.' + str(len(temporary)))
+                t = open(temporary[-1], 'w')
+                w = csv.writer(t, dialect=g_file_dialect)
+                w.writerows([y[1] for y in run])
+                t.close()
+                run = []
+            if (row is None):
+                break
+
+        # merge the runs into new rotated files, each with its unix time range
+        runs = [open(x, 'r') for x in temporary]
+        merged = heapq.merge(*[((long(y[0]), y) for y in csv.reader(x, dialect=g_file_dialect)) for x in runs])
+        segments = []
+        n = 0
+        f = None
+        row_last = None
+        for unixtime, row in merged:
+            if unique and (row == row_last):
+                continue
+            row_last = row
+            if (f is None):
+                temporary.append(fname + '.compact.' + str(len(temporary)))
+                segments.append([temporary[-1], unixtime, unixtime])
+                f = open(temporary[-1], 'w')
+                ds_create(f, schema)
+                w = csv.writer(f, dialect=g_file_dialect)
+            w.writerow(row)
+            segments[-1][2] = unixtime
+            n += 1
+            if (f.tell() >= size):
+                f.close()
+                f = None
+        if (f is not None):
+            f.close()
+        for x in runs:
+            x.close()
+
+        # move the new files into place, then swap the manifest entries; files rotated meanwhile are kept
+        f = ds_manifest_lock(fname)
+        entries = ds_manifest_read(fname)
+        number = max([long(x[0].split('.')[0]) for x in entries] + [0]) + 1
+        new_entries = []
+        for x in segments:
+            suffix = str(number) + '.' + str(x[1])
+            number += 1
+            os.rename(x[0], fname + '.' + suffix)
+            if g_index:
+                t = open(fname + '.' + suffix, 'r')
+                ds_index_update(t, True)
+                t.close()
+            if g_rotate_compress:
+                ds_compress(fname + '.' + suffix, g_rotate_compress)
+            new_entries.append([suffix, x[1], x[2], True])
+        ds_manifest_write(fname, new_entries + [x for x in entries if x[0] not in suffixes])
+        if (f is not None):
+            f.close()
+    except Error:
+        raise
+    except:
+        raise DiskError(fname)
+    finally:
+        for x in temporary:
+            if os.path.isfile(x):
+                os.remove(x)
+    for x in suffixes:
+        ds_segment_delete(fname + '.' + x)
+    return n
+
+def ds_compress ( fname, extension ):
+    """Replaces a data set file and its index by a copy compressed with the codec for extension"""
+
+    import shutil
+    # the compressed copy is complete before the original is removed, so readers always find one of them
+    fname_to = fname + extension
+    fname_temporary = fname + '.tmp' + extension
+    try:
+        t = open(fname, 'rb')
+        t2 = util_compressed_open(fname_temporary, 'wb')
+        shutil.copyfileobj(t, t2, g_compress_size)
+        t2.close()
+        t.close()
+        os.rename(fname_temporary, fname_to)
+        os.remove(fname)
+        if os.path.isfile(ds_index_filename(fname)):
+            os.remove(ds_index_filename(fname))
+    except:
+        raise DiskError(fname)
+    return
+
 def ds_create ( f, schema ):
     """Creates a new data set"""
     
+    # the schema is followed by padding so that keys can be added later without moving rows
     try:
         f.seek(0)
-        w = csv.writer(f, delimiter=g_file_delimiter, escapechar=g_file_escapechar, lineterminator=g_file_line_terminator, quoting=g_file_quoting, quotechar=g_file_quotechar)
-        w.writerow(schema)
+        f.write(util_schema_line(schema, g_schema_reserve))
     except:
         raise DiskError(f.name)
     return
 
+def ds_create_file ( fname, schema, replace ):
+    """Creates a data set file with schema in one step, replacing an existing file only if replace is set"""
+
+    # the file is prepared under a temporary name, so that other processes never find it without a schema
+    temporary = fname + '.' + str(os.getpid()) + '.tmp'
+    try:
+        f = open(temporary, 'w')
+        ds_create(f, schema)
+        f.close()
+        if replace:
+            os.rename(temporary, fname)
+        else:
+            try:
+                os.link(temporary, fname)
+            except OSError as e:
+                if (e.errno != errno.EEXIST):
+                    raise
+            os.remove(temporary)
+    except:
+        raise DiskError(fname)
+    return
+
 def ds_delete ( fname ):
     """Deletes a data set"""
    
@@ -139,59 +364,331 @@ def ds_exists ( fname ):
         raise DiskError(fname)
     return t
 
+def ds_expire ( fname, suffixes ):
+    """Removes rotated files of a data set file, and their manifest entries"""
+
+    # the manifest is replaced first, so that a reader never finds an entry for a file that is gone
+    f = ds_manifest_lock(fname)
+    try:
+        entries = ds_manifest_read(fname)
+        ds_manifest_write(fname, [x for x in entries if x[0] not in suffixes])
+    finally:
+        if f is not None:
+            f.close()
+    for x in suffixes:
+        ds_segment_delete(fname + '.' + x)
+    return
+
 def ds_filename ( name ):
     """Returns file system representation of data set"""
     
     fname = g_file_path_root + name + g_file_extension
     return fname
    
-def ds_query ( f, name, begin, end, return_timestamp ):
-    """Returns a JSON document based on query parameters.  Parameters are assumed to be correct"""
+def ds_index_build ( f ):
+    """Rebuilds the time index of a data set from scratch"""
 
-    result = []
-    schema = ds_schema_read(f)
-    #make no assumptions about where file pointer is
-    f.seek(0)
+    fname = ds_index_filename(f.name)
     try:
-        r = csv.reader(f, delimiter=g_file_delimiter, escapechar=g_file_escapechar, lineterminator=g_file_line_terminator, quoting=g_file_quoting, quotechar=g_file_quotechar)
-        first_row_skipped = False
-        for row in r:
-            if first_row_skipped:
-                #unixtime is assumed to be key 1
-                unixtime = long(row[0])
-                if (begin <= unixtime <= end):
-                    if not return_timestamp:
-                        #timestamp is assumed to be key 2
-                        del row[1]
-                    result.append(row)
-            else:
-                first_row_skipped = True
+        if os.path.isfile(fname):
+            os.remove(fname)
+    except:
+        raise DiskError(fname)
+    return ds_index_update(f, False)
+
+def ds_index_filename ( fname ):
+    """Returns file system representation of the time index of a data set file"""
+
+    return fname + g_index_extension
+
+def ds_index_read ( f ):
+    """Returns a list of (begin, end, rows, unixtime_min, unixtime_max) index entries for a data set, or an empty list"""
+
+    # index entries cover consecutive byte ranges of the data set, starting after the schema
+    fname = ds_index_filename(f.name)
+    index = []
+    try:
+        if not os.path.isfile(fname):
+            return index
+        t = open(fname, 'r')
+        for line in t:
+            if not line.endswith(g_file_line_terminator):
+                break
+            index.append(tuple([long(x) for x in line.split(g_file_delimiter)]))
+        t.close()
+        size = os.fstat(f.fileno()).st_size
+    except ValueError:
+        return []
+    except:
+        raise DiskError(fname)
+
+    # an index that does not fit the data set is stale and treated as absent
+    if index and (index[-1][1] > size):
+        return []
+    return index
+
+def ds_index_update ( f, close ):
+    """Appends entries to the time index of a data set for rows not yet indexed.  Returns number of entries added"""
+
+    # a block is indexed once it reaches g_index_size bytes, or when close is set, e.g. before rotation
+    fname = ds_index_filename(f.name)
+    try:
+        f.flush()
+        index = ds_index_read(f)
+        if index:
+            begin = index[-1][1]
+        else:
+            f.seek(0)
+            f.readline()
+            begin = f.tell()
+        size = os.fstat(f.fileno()).st_size
+        if ((size - begin) < g_index_size) and not close:
+            return 0
+
+        entries = []
+        block = [begin, begin, 0, None, None]
+        for line in ds_lines(f, begin, size):
+            if not line.endswith(g_file_line_terminator):
+                break
+            unixtime = util_row_unixtime(line)
+            block[1] += len(line)
+            block[2] += 1
+            if (block[3] is None) or (unixtime < block[3]):
+                block[3] = unixtime
+            if (block[4] is None) or (unixtime > block[4]):
+                block[4] = unixtime
+            if ((block[1] - block[0]) >= g_index_size):
+                entries.append(block)
+                block = [block[1], block[1], 0, None, None]
+        if close and (block[2] > 0):
+            entries.append(block)
+
+        if entries:
+            # entries are only added if no other process has indexed the same rows meanwhile
+            import fcntl
+            t = open(fname, 'a')
+            fcntl.flock(t.fileno(), fcntl.LOCK_EX)
+            index = ds_index_read(f)
+            if (index and (index[-1][1] != begin)) or (not index and (os.fstat(t.fileno()).st_size > 0)):
+                entries = []
+            for x in entries:
+                t.write(g_file_delimiter.join([str(y) for y in x]) + g_file_line_terminator)
+            t.close()
+    except:
+        raise DiskError(fname)
+    return len(entries)
+
+def ds_lines ( f, begin, end ):
+    """Yields the lines of a data set between two offsets"""
+
+    f.seek(begin)
+    pos = begin
+    while (pos < end):
+        line = f.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line
+
+def ds_lines_ordered ( f, begin, end, state ):
+    """Yields the lines of a time-ordered data set from an offset until a row past unixtime end"""
+
+    # state[0] receives the offset of the first row found out of order, if any
+    f.seek(begin)
+    pos = begin
+    unixtime_last = 0
+    for line in iter(f.readline, ''):
+        unixtime = util_row_unixtime(line)
+        if (unixtime < unixtime_last):
+            state[0] = pos
+            break
+        if (unixtime > end):
+            break
+        unixtime_last = unixtime
+        pos += len(line)
+        yield line
+
+def ds_lock ( f, exclusive ):
+    """Locks a data set file, shared or exclusive, first moving the open file over to the current data set file if it has been rotated"""
+
+    import fcntl
+    try:
+        while True:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            t = os.stat(f.name)
+            t2 = os.fstat(f.fileno())
+            if (t.st_ino == t2.st_ino) and (t.st_dev == t2.st_dev):
+                break
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            util_reopen(f)
     except:
         raise DiskError(f.name)
+    return
+
+def ds_manifest_filename ( fname ):
+    """Returns file system representation of the manifest of rotated files of a data set file"""
+
+    return fname + g_manifest_extension
+
+def ds_manifest_lock ( fname ):
+    """Returns a data set file locked exclusively, so that its manifest can be changed, or None if it does not exist"""
+
+    # rotations change the manifest under the same lock
+    try:
+        f = open(fname, 'r')
+    except IOError as e:
+        if (e.errno != errno.ENOENT):
+            raise DiskError(fname)
+        return None
+    ds_lock(f, True)
+    return f
+
+def ds_manifest_read ( fname ):
+    """Returns a list of [suffix, unixtime_min, unixtime_max, ordered] entries for the rotated files of a data set file, oldest first"""
+
+    # unix times are None when unknown, and ordered is set for files known to be sorted by unix time; without a
+    # manifest, rotated files are numbered from max to 1, oldest first
+    mname = ds_manifest_filename(fname)
+    entries = []
+    try:
+        if not os.path.isfile(mname):
+            for i in range(g_rotate_max, 0, -1):
+                if os.path.isfile(fname + '.' + str(i)):
+                    entries.append([str(i), None, None, False])
+            return entries
+        t = open(mname, 'r')
+        for line in t:
+            x = line.rstrip(g_file_line_terminator).split(g_file_delimiter)
+            entries.append([x[0]] + [(long(y) if y else None) for y in x[1:3]] + [(len(x) > 3) and (x[3] == '1')])
+        t.close()
+    except:
+        raise DiskError(mname)
+    return entries
+
+def ds_manifest_write ( fname, entries ):
+    """Replaces the manifest of rotated files of a data set file"""
+
+    mname = ds_manifest_filename(fname)
+    try:
+        t = open(mname + '.tmp', 'w')
+        for x in entries:
+            t.write(g_file_delimiter.join([('' if y is None else str(y)) for y in x[:3]] + (['1'] if x[3] else [])) + g_file_line_terminator)
+        t.close()
+        os.rename(mname + '.tmp', mname)
+    except:
+        raise DiskError(mname)
+    return
+
+def ds_open ( fname, keys ):
+    """Opens a data set for writing, creating it with keys as schema if it does not exist"""
+
+    if not ds_exists(fname):
+        ds_create_file(fname, keys, False)
+    try:
+        f = open(fname, 'a+')
+    except:
+        raise DiskError(fname)
+    return f
+
+def ds_query ( f, name, begin, end, return_timestamp ):
+    """Returns a JSON document based on query parameters.  Parameters are assumed to be correct"""
+
+    fragments = list(ds_query_iter(f, name, begin, end, return_timestamp))
+    return len(fragments) - 2, ''.join(fragments)
+
+def ds_query_iter ( f, name, begin, end, return_timestamp ):
+    """Yields a JSON document based on query parameters as the head of the document, one fragment per row, and the tail"""
+
+    import json
+    schema = ds_schema_read(f)
     if not return_timestamp:
         #timestamp hard-coded to field no 2
         del schema[1]
-    keys = ""
-    i = 0
-    for x in schema:
-        i += 1
-        keys = keys + "\"" + x + "\""
-        if (i < len(schema)):
-            keys = keys + ", "
-    output = "{"
-    output = output + " \"dataset\": \"" + name + "\"," 
-    output = output + " \"keys\": [" + keys + "]," 
-    output = output + " \"values\": " 
-    output = output + "[ " 
-    i = 0
-    for x in result:
-        i += 1
-        output = output + json.dumps(x) 
-        if (i < len(result)):
-            output = output + ", "
-    output = output + " ]" 
-    output = output + " }"
-    return i, output
+    keys = ", ".join(["\"" + x + "\"" for x in schema])
+    yield "{ \"dataset\": \"" + name + "\", \"keys\": [" + keys + "], \"values\": [ "
+    separator = ""
+    try:
+        for row in ds_query_segments(f, begin, end):
+            if not return_timestamp:
+                #timestamp is assumed to be key 2
+                del row[1]
+            yield separator + json.dumps(row)
+            separator = ", "
+    except Exception:
+        raise DiskError(f.name)
+    yield " ] }"
+
+def ds_query_rows ( f, begin, end, ordered ):
+    """Yields rows of a data set that match query parameters, seeking by bisection only if its rows are known to be ordered by unix time"""
+
+    f.seek(0)
+    f.readline()
+    start = f.tell()
+    size = os.fstat(f.fileno()).st_size
+    index = []
+    if g_index:
+        index = ds_index_read(f)
+    ranges = [(start, size)]
+    if index:
+        # scan only indexed blocks overlapping the range, then the rows not yet indexed
+        ranges = [(x[0], x[1]) for x in index if (x[3] <= end) and (x[4] >= begin)]
+        ranges.append((index[-1][1], size))
+    elif g_query_seek and ordered:
+        # bisection probes only a few rows, so it cannot tell rows written out of order, e.g. by concurrent writers
+        offset = ds_seek(f, begin)
+        if offset is not None:
+            # stream from the first row in range until the first row past end
+            state = [None]
+            for row in util_rows(ds_lines_ordered(f, offset, end, state), begin, end):
+                yield row
+            ranges = []
+            if state[0] is not None:
+                # fall back to a full scan of the rows not yet read for data sets that are not time-ordered
+                ranges = [(start, offset), (state[0], size)]
+    for x in ranges:
+        for row in util_rows(ds_lines(f, x[0], x[1]), begin, end):
+            yield row
+
+def ds_query_segments ( f, begin, end ):
+    """Yields rows of a data set and its rotated files that match query parameters, oldest file first and ordered to the current schema"""
+
+    # rows written before keys were added are shorter than the schema, and are padded with empty values
+
+    schema = ds_schema_read(f)
+    for x in ds_manifest_read(f.name):
+        # skip rotated files entirely outside the range, without opening them when the manifest knows their range
+        if (x[1] is not None) and ((x[1] > end) or (x[2] < begin)):
+            continue
+        fname, t = ds_segment_open(f.name + '.' + x[0])
+        if t is None:
+            continue
+        try:
+            compressed = (fname != f.name + '.' + x[0])
+            # a range unknown to the manifest is taken from a complete index only, as finding it otherwise reads
+            # as much as the query itself
+            unixtime_range = None
+            if (x[1] is None) and not compressed:
+                unixtime_range = ds_segment_range(t, False)
+            if (unixtime_range is not None) and ((unixtime_range[0] > end) or (unixtime_range[1] < begin)):
+                continue
+            # rotated files keep the schema they had at the time of rotation
+            schema_segment = ds_schema_read(t)
+            order = util_values_mapper(schema, schema_segment)
+            n = len(schema_segment)
+            if compressed:
+                # compressed files are read as a stream, from the first row on
+                t.seek(0)
+                t.readline()
+                rows = util_rows(iter(t.readline, ''), begin, end)
+            else:
+                rows = ds_query_rows(t, begin, end, x[3])
+            for row in rows:
+                yield order(util_row_pad(row, n))
+        finally:
+            t.close()
+    n = len(schema)
+    for row in ds_query_rows(f, begin, end, False):
+        yield util_row_pad(row, n)
 
 def ds_rename ( fname_from, fname_to ):
     """Renames a data set"""
@@ -202,51 +699,79 @@ def ds_rename ( fname_from, fname_to ):
         raise DiskError(fname_from + " " + fname_to)
     return
 
-def ds_rotate ( name ):
-    """Rotates data set files to manage maximum file size"""
+def ds_rotate ( f, name, unixtime ):
+    """Rotates a data set file according to the rotation policy of the data set, before adding rows up to unixtime, if known.  Returns size of the data set file before rotation"""
    
+    t, rotate = ds_rotate_due(f, name, unixtime)
+    if rotate:
+        # check again under the lock, as another process may have rotated the data set meanwhile
+        ds_lock(f, True)
+        try:
+            t, rotate = ds_rotate_due(f, name, unixtime)
+            if rotate:
+                ds_segment_new(f, ds_schema_read(f))
+        finally:
+            ds_unlock(f)
+    return t
+
+def ds_rotate_due ( f, name, unixtime ):
+    """Returns size of a data set file, and boolean for whether it is due for rotation, before adding rows up to unixtime, according to the rotation policy of the data set"""
+
+    # the size is taken from the open data set file, so only a rotation itself costs further I/O unless the policy
+    # includes time or rows; time-based files start at multiples of the interval since the epoch, and rotate when
+    # rows of a later interval than that of their first row are added, so that backfilled rows do not rotate them
+    size, interval, rows = util_rotate_policy(name)
     try:
-        fname = ds_filename(name)
-        t = os.path.getsize(fname)
-        if (t >= g_rotate_size):
-            # preserve existing schema
-            f = open(fname, 'r')
-            schema = ds_schema_read(f)
-            f.close
-
-            # rotate files fro max to 1 to original
-            for i in range(g_rotate_max, -1, -1):
-                fname_to = fname + '.' + str(i)
-                if (i == g_rotate_max):
-                    fname_delete = fname + '.' + str(i)
-                    if os.path.isfile(fname_delete):
-                        os.remove(fname_delete)
-                elif (i == 0):
-                    fname_from = fname 
-                    fname_to = fname + '.' + str(i+1)
-                    if os.path.isfile(fname_from):
-                        os.rename(fname_from, fname_to)
-                else:
-                    fname_from = fname + '.' + str(i)
-                    fname_to = fname + '.' + str(i+1)
-                    if os.path.isfile(fname_from):
-                        os.rename(fname_from, fname_to)
-
-            # write new empty file
-            f = open(fname, 'w')
-            ds_create(f, schema)
-            f.close
+        f.flush()
+        t = os.fstat(f.fileno()).st_size
+        rotate = (size > 0) and (t >= size)
+        if not rotate and (interval > 0) and (unixtime is not None):
+            f.seek(0)
+            f.readline()
+            line = f.readline()
+            if line.endswith(g_file_line_terminator):
+                rotate = ((util_row_unixtime(line) // 1000000 // interval) < (long(unixtime) // 1000000 // interval))
+        if not rotate and (rows > 0):
+            rotate = (ds_row_count(f) >= rows)
+    except Error:
+        raise
     except:
-        raise DiskError(fname)
-    return t
+        raise DiskError(f.name)
+    return t, rotate
+
+def ds_row_count ( f ):
+    """Returns the number of rows in a data set file"""
+
+    # indexed blocks know their number of rows, so only the rows not yet indexed are counted
+    try:
+        f.flush()
+        index = []
+        if g_index:
+            index = ds_index_read(f)
+        if index:
+            n = sum([x[2] for x in index])
+            f.seek(index[-1][1])
+        else:
+            n = 0
+            f.seek(0)
+            f.readline()
+        while True:
+            t = f.read(g_index_size)
+            if not t:
+                break
+            n += t.count(g_file_line_terminator)
+    except:
+        raise DiskError(f.name)
+    return n
 
 def ds_row_write ( f, row ):
     """Writes a list to data set"""
 
+    csv = util_csv()
     # assume that : setbase exists, row contains the correct number of columms, row is ordered to current schema
     row_new = util_values_clean(row)
     try:
-        w = csv.writer(f, delimiter=g_file_delimiter, escapechar=g_file_escapechar, lineterminator=g_file_line_terminator, quoting=g_file_quoting, quotechar=g_file_quotechar)
+        w = csv.writer(f, dialect=g_file_dialect)
         w.writerow(row_new)
     except:
         raise DiskError(f.name)
@@ -255,88 +780,353 @@ def ds_row_write ( f, row ):
 def ds_schema_modify ( f, new_keys ):
     """Appends to the schema of a data set"""
   
+    # existing rows are left as is, and are read as having empty values for the new keys; the data set file is
+    # rewritten through a file not opened for appending, and is assumed to be locked exclusively
     try:
-        total_new_keys = len(new_keys)
-    
-        # copy content of existing ds to temporary ds while adding new keys to schema and empty data for those keys
-        f.seek(0)
-        r = csv.reader(f, delimiter=g_file_delimiter, escapechar=g_file_escapechar, lineterminator=g_file_line_terminator, quoting=g_file_quoting, quotechar=g_file_quotechar)
-        t = open(g_file_temporary, 'w')
-        w = csv.writer(t, delimiter=g_file_delimiter, quoting=g_file_quoting, quotechar=g_file_quotechar)
-        first_row = True
-        for row in r:
-            if not first_row:
-                for x in range(1, total_new_keys + 1):
-                    row.append('')
-            else:
-                for i in new_keys:
-                    row.append(i)
-                first_row = False
-            w.writerow(row)
+        f.flush()
+        t = open(f.name, 'r+')
+        line = t.readline()
+        start = t.tell()
+        schema = ds_schema_read(t)
+        # keys may have been added by another process since the schema was last read
+        new_keys = util_key_new(schema, new_keys)
+        if not new_keys:
+            t.close()
+            return
+        schema = schema + new_keys
+        size = len(line) - len(util_schema_line(schema, 0))
+        if (size >= 0):
+            # grow the schema into its padding
+            t.seek(0)
+            t.write(util_schema_line(schema, size))
+            t.close()
+            return
+
+        # otherwise make room by shifting rows toward the end, last block first, with the padding at least doubled
+        line = util_schema_line(schema, max(g_schema_reserve, len(line)))
+        shift = len(line) - start
+        end = os.fstat(t.fileno()).st_size
+        while (end > start):
+            n = min(g_schema_shift_size, end - start)
+            end -= n
+            t.seek(end)
+            x = t.read(n)
+            t.seek(end + shift)
+            t.write(x)
+        t.seek(0)
+        t.write(line)
         t.close()
-    
-        # empty content of current ds
-        f.seek(0)
-        f.truncate()
-       
-        # copy content of temporary ds to existing ds
-        t = open(g_file_temporary, 'r')
-        r2 = csv.reader(t, delimiter=g_file_delimiter, escapechar=g_file_escapechar, lineterminator=g_file_line_terminator, quoting=g_file_quoting, quotechar=g_file_quotechar)
-        w2 = csv.writer(f, delimiter=g_file_delimiter, escapechar=g_file_escapechar, lineterminator=g_file_line_terminator, quoting=g_file_quoting, quotechar=g_file_quotechar)
-        for row in r2:
-            w2.writerow(row)
-        t.close()
-
-        os.remove(g_file_temporary)
     except:
         raise DiskError(f.name)
+
+    # offsets have moved, so the index is rebuilt
+    if g_index:
+        ds_index_build(f)
     return
 
 def ds_schema_read ( f ):
     """Returns a list which represents the schema of a dataset"""
   
+    csv = util_csv()
     try:
         f.seek(0)
-        r = csv.reader(f, delimiter=g_file_delimiter, escapechar=g_file_escapechar, lineterminator=g_file_line_terminator, quoting=g_file_quoting, quotechar=g_file_quotechar)
+        r = csv.reader(f, dialect=g_file_dialect)
         schema = r.next()
     except:
         raise DiskError(f.name)
+
+    # a blank last key is padding, as keys are never blank
+    if schema and (len(schema[-1].strip()) == 0):
+        del schema[-1]
     return schema
 
+def ds_segment_range ( f, scan ):
+    """Returns (unixtime_min, unixtime_max) of a data set file that is no longer written from its complete index, or by reading every row if scan is set, or None if unknown"""
+
+    try:
+        size = os.fstat(f.fileno()).st_size
+        index = []
+        if g_index:
+            index = ds_index_read(f)
+        if index and (index[-1][1] == size):
+            return min([x[3] for x in index]), max([x[4] for x in index])
+        if not scan:
+            return None
+
+        # otherwise every row is read, as the first and last rows only bound data sets known to be time-ordered
+        unixtime_range = None
+        f.seek(0)
+        f.readline()
+        for line in iter(f.readline, ''):
+            unixtime = util_row_unixtime(line)
+            if (unixtime_range is None):
+                unixtime_range = [unixtime, unixtime]
+            unixtime_range = [min(unixtime_range[0], unixtime), max(unixtime_range[1], unixtime)]
+        if (unixtime_range is None):
+            return None
+        return tuple(unixtime_range)
+    except ValueError:
+        return None
+    except:
+        raise DiskError(f.name)
+
+def ds_segment_delete ( fname ):
+    """Deletes a rotated file, whether compressed or not, and its index"""
+
+    for x in [fname, ds_index_filename(fname)] + [fname + y for y in g_compress_extensions]:
+        try:
+            os.remove(x)
+        except OSError as e:
+            if (e.errno != errno.ENOENT):
+                raise DiskError(x)
+    return
+
+def ds_segment_new ( f, schema ):
+    """Moves a data set file to a new rotated file, and starts a new data set file with schema which the open file then refers to"""
+
+    # rotated files are numbered upwards, labelled with the unix time of their first row, and listed in the manifest,
+    # so rotation renames only the data set file
+    fname = f.name
+    try:
+        entries = ds_manifest_read(fname)
+        f.flush()
+        if g_index:
+            # index remaining rows before the file leaves the hot position
+            ds_index_update(f, True)
+        unixtime_range = ds_segment_range(f, True) or (None, None)
+
+        n = max([long(x[0].split('.')[0]) for x in entries] + [0]) + 1
+        suffix = str(n)
+        if (unixtime_range[0] is not None):
+            suffix += '.' + str(unixtime_range[0])
+        entries.append([suffix, unixtime_range[0], unixtime_range[1], False])
+        expired = entries[:-g_rotate_max]
+        del entries[:-g_rotate_max]
+
+        # the manifest is replaced first, so that a reader never finds an entry for a file that is gone
+        ds_manifest_write(fname, entries)
+        # the data set file is linked under its new name before a new empty file replaces it, so that processes
+        # opening the data set always find a file
+        os.link(fname, fname + '.' + suffix)
+        if os.path.isfile(ds_index_filename(fname)):
+            os.rename(ds_index_filename(fname), ds_index_filename(fname + '.' + suffix))
+        ds_create_file(fname, schema, True)
+        for x in expired:
+            ds_segment_delete(fname + '.' + x[0])
+        if g_rotate_compress:
+            util_background(ds_compress, fname + '.' + suffix, g_rotate_compress)
+
+        # move the open file over to the new file
+        util_reopen(f)
+    except:
+        raise DiskError(fname)
+    return
+
+def ds_segment_open ( fname ):
+    """Returns the name and an open file of a rotated file, which may have been compressed, or (None, None) if it does not exist"""
+
+    # the uncompressed file is tried first, as it is removed only once its compressed copy is complete
+    for x in [''] + g_compress_extensions:
+        try:
+            if x:
+                return fname + x, util_compressed_open(fname + x, 'rb')
+            return fname, open(fname, 'r')
+        except IOError as e:
+            if (e.errno != errno.ENOENT):
+                raise DiskError(fname + x)
+    return None, None
+
+def ds_segment_rename ( fname_from, fname_to ):
+    """Renames a rotated file, whether compressed or not, and its index"""
+
+    names = [(fname_from, fname_to), (ds_index_filename(fname_from), ds_index_filename(fname_to))]
+    for x, y in names + [(fname_from + z, fname_to + z) for z in g_compress_extensions]:
+        try:
+            os.rename(x, y)
+        except OSError as e:
+            if (e.errno != errno.ENOENT):
+                raise DiskError(x + " " + y)
+    return
+
+def ds_segment_rows ( fname, suffixes, schema ):
+    """Yields all rows of rotated files of a data set file, ordered to schema"""
+
+    csv = util_csv()
+    for x in suffixes:
+        t = ds_segment_open(fname + '.' + x)[1]
+        if t is None:
+            continue
+        try:
+            schema_segment = ds_schema_read(t)
+            order = util_values_mapper(schema, schema_segment)
+            n = len(schema_segment)
+            t.seek(0)
+            t.readline()
+            for row in csv.reader(iter(t.readline, ''), dialect=g_file_dialect):
+                yield order(util_row_pad(row, n))
+        finally:
+            t.close()
+
+def ds_segment_stat ( fname ):
+    """Returns (bytes, modification time) of a rotated file, whether compressed or not, and its index"""
+
+    size = 0
+    mtime = None
+    for x in [fname, ds_index_filename(fname)] + [fname + y for y in g_compress_extensions]:
+        try:
+            t = os.stat(x)
+        except OSError as e:
+            if (e.errno != errno.ENOENT):
+                raise DiskError(x)
+            continue
+        size += t.st_size
+        mtime = max(mtime, t.st_mtime)
+    return size, mtime
+
+def ds_segments ( fname ):
+    """Returns list of rotated files of a data set file, oldest first"""
+
+    segments = []
+    for x in ds_manifest_read(fname):
+        for y in [''] + g_compress_extensions:
+            t = fname + '.' + x[0] + y
+            if ds_exists(t):
+                segments.append(t)
+                break
+    return segments
+
+def ds_seek ( f, begin ):
+    """Returns the offset of the first row at or after begin via bisection, or None if the data set is not time-ordered"""
+
+    # rows are assumed to be single lines beginning with unixtime
+    try:
+        f.seek(0)
+        f.readline()
+        lo = f.tell()
+        hi = os.fstat(f.fileno()).st_size
+        probes = [(lo, util_row_unixtime(f.readline()))]
+        while (lo < hi):
+            mid = (lo + hi) // 2
+            # re-sync to the start of the first line at or after mid
+            f.seek(mid - 1)
+            f.readline()
+            pos = f.tell()
+            if (pos >= hi):
+                hi = mid
+                continue
+            line = f.readline()
+            unixtime = util_row_unixtime(line)
+            probes.append((pos, unixtime))
+            if (unixtime < begin):
+                lo = pos + len(line)
+            else:
+                hi = mid
+    except ValueError:
+        return None
+    except:
+        raise DiskError(f.name)
+
+    # probes taken in file order must also be in time order
+    probes.sort()
+    for i in range(1, len(probes)):
+        if (probes[i][1] < probes[i-1][1]):
+            return None
+    return lo
+
+def ds_unlock ( f ):
+    """Unlocks a data set file"""
+
+    import fcntl
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    except:
+        raise DiskError(f.name)
+    return
+
 def ds_write( f, keys, values ):
     """Writes a list to a data set."""
  
-    # keys do not have to be ordered, but are assumed to contain time 
-    schema = ds_schema_read(f)
-    new_keys = util_key_new(schema, keys)
-    total_new_keys = len(new_keys)
-    if (total_new_keys > 0):
-        ds_schema_modify(f, new_keys)
-        schema = ds_schema_read(f)
-    f.seek(0, 2)
-    n = 0
-    for row in values:
-        ordered_row = util_values_order(schema, keys, row)
-        ds_row_write(f, ordered_row)
-        n = n + 1
+    n, schema = ds_append(f, ds_schema_read(f), keys, values)
     return n
 
-def util_is_int(s):
-    """Returns boolean for validity of integer"""
+def util_background ( function, *args ):
+    """Calls a function in a background process, without waiting for it"""
 
-    try: 
-        int(s)
-        return True
-    except ValueError:
-        return False
+    # the first child exits at once, so that the second is adopted by init and never needs to be waited for
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if (pid > 0):
+        os.waitpid(pid, 0)
+        return
+    try:
+        if (os.fork() == 0):
+            function(*args)
+    finally:
+        os._exit(0)
 
-def util_json_bad ( s_json ):
-    """Returns boolean for validity of JSON document"""
+def util_compressed_open ( fname, mode ):
+    """Returns a file object which compresses or decompresses a file according to its extension"""
 
-    try: 
-        t = json.loads(s_json, strict=False)
-    except ValueError:
-        return True
+    if fname.endswith('.bz2'):
+        import bz2
+        return bz2.BZ2File(fname, mode)
+    import gzip
+    return gzip.GzipFile(fname, mode)
+
+def util_csv ( ):
+    """Returns the csv module, with the data set dialect registered"""
+
+    import csv
+    if g_file_dialect not in csv.list_dialects():
+        csv.register_dialect(g_file_dialect, delimiter=g_file_delimiter, escapechar=g_file_escapechar, lineterminator=g_file_line_terminator, quoting=g_file_quoting, quotechar=g_file_quotechar)
+    return csv
+
+def util_daemon_connect ( address ):
+    """Returns a socket connected to the ingest daemon listening on address, or None if none is listening"""
+
+    import socket
+    try:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(g_daemon_timeout)
+        s.connect(address)
+    except socket.error:
+        return None
+    return s
+
+def util_daemon_send ( s, address, data ):
+    """Sends a JSON string to the ingest daemon connected on socket s.  Returns number of rows and data set"""
+
+    import socket
+    try:
+        s.sendall(data)
+        s.shutdown(socket.SHUT_WR)
+        response = ''
+        for x in iter(lambda: s.recv(4096), ''):
+            response = response + x
+        s.close()
+    except socket.error:
+        raise NetworkError(address)
+
+    # response is 0|rows|dataset on success, or 1|description on error
+    t = response.rstrip(g_file_line_terminator).split(g_file_delimiter, 2)
+    if (t[0] == '0') and (len(t) == 3):
+        return long(t[1]), t[2]
+    if (t[0] == '1') and (len(t) > 1):
+        raise DaemonError(g_file_delimiter.join(t[1:]))
+    raise NetworkError(address)
+
+def util_dataset_lock ( name ):
+    """Returns the lock which serialises the writes of threads to a data set, or None if threads do not write"""
+
+    if g_dataset_locks is None:
+        return None
+    import threading
+    # setdefault is atomic, so threads asking for a new data set at once share one lock
+    return g_dataset_locks.setdefault(name, threading.Lock())
+
+def util_document_bad ( t ):
+    """Returns boolean for validity of parsed JSON document"""
 
     try: 
         name = t["dataset"]
@@ -347,24 +1137,116 @@ def util_json_bad ( s_json ):
     except TypeError:
         return True
 
-    if (len(keys) != len(values[0])):
+    if not (isinstance(name, basestring) and isinstance(keys, list) and isinstance(values, list)):
         return True
 
     if (len(keys) == 0):
         return True
-        
-    if (len(values[0]) == 0):
+
+    if (len(values) == 0):
         return True
 
+    # every row must be as wide as the keys
+    width = len(keys)
+    for row in values:
+        if not isinstance(row, list):
+            return True
+        if (len(row) != width):
+            return True
+
     if (len(name.rstrip()) == 0):
         return True
 
     return False
-  
+
+def util_document_prepare ( t ):
+    """Returns name, keys and values of a parsed JSON document, with unixtime and timestamp added"""
+
+    if util_document_bad(t):
+        raise BadJsonError(str(t))
+        return
+
+    name = t["dataset"]
+    keys = t["keys"]
+    values = t["values"]
+
+    if util_key_bad(keys):
+        raise BadKeysError(str(keys))
+        return
+
+    util_keys_values_add_time(keys, values)
+    return name, keys, values
+
+def util_fragments_write ( f, fragments ):
+    """Writes a fragmented JSON document as it is generated.  Returns number of rows, and writes nothing for no rows"""
+
+    # fragments are the head of the document, one per row, then the tail
+    head = fragments.next()
+    previous = fragments.next()
+    n = 0
+    for x in fragments:
+        if (n == 0):
+            f.write(head)
+        f.write(previous)
+        n += 1
+        previous = x
+    if (n > 0):
+        f.write(previous + '\n')
+    return n
+
+def util_http_put ( host, port, location, data ):
+    """Sends a JSON string to a remote node, and returns its response"""
+
+    import urllib2
+
+    url = 'http://' + host + ':' + str(port) + location
+    proxy_handler = urllib2.ProxyHandler(g_http_proxies)
+    opener = urllib2.build_opener(proxy_handler)
+    header = {}
+    header['Content-Type'] = 'application/json'
+    request = urllib2.Request(url, data, header)
+    request.get_method = lambda: 'PUT'
+    try:
+        f = opener.open(request)
+        response = f.read()
+        f.close()
+    except:
+        raise NetworkError(url)
+    return response
+
+def util_is_int(s):
+    """Returns boolean for validity of integer"""
+
+    try: 
+        int(s)
+        return True
+    except ValueError:
+        return False
+
+def util_iter_close ( f, iterable ):
+    """Yields from an iterable, closing a file once it is exhausted or abandoned"""
+
+    try:
+        for x in iterable:
+            yield x
+    finally:
+        f.close()
+
+def util_json_bad ( s_json ):
+    """Returns boolean for validity of JSON document"""
+
+    import json
+    try: 
+        t = json.loads(s_json, strict=False)
+    except ValueError:
+        return True
+
+    return util_document_bad(t)
 
 def util_json_get_value ( s_json, key ):
     """Returns value for supplied key in JSON document"""
 
+    import json
     try: 
         t = json.loads(s_json, strict=False)
     except ValueError:
@@ -458,20 +1340,272 @@ def util_keys_values_add_time ( keys, values ):
             x[:0] = [unixtime, timestamp]
     return
   
-def util_timestamp ( ):
-    """Return a timestamp string"""
+def util_lines_prepare ( lines ):
+    """Returns list of name, keys and values, one per data set, of newline-delimited JSON strings, with unixtime and timestamp added"""
+
+    import json
+
+    # all documents are parsed before any is added, and the documents of each data set are merged
+    names = []
+    documents = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            t = json.loads(line, strict=False)
+        except ValueError:
+            raise BadJsonError(line)
+            return
+        name, keys, values = util_document_prepare(t)
+        if name not in documents:
+            names.append(name)
+            documents[name] = []
+        documents[name].append((keys, values))
+
+    result = []
+    for name in names:
+        keys = []
+        for x in documents[name]:
+            keys += util_key_new(keys, x[0])
+        values = []
+        for x in documents[name]:
+            order = util_values_mapper(keys, x[0])
+            values.extend([order(y) for y in x[1]])
+        result.append((name, keys, values))
+    return result
+
+def util_log_close ( ):
+    """Writes the messages still queued for the log, then stops the log writer"""
+
+    global g_log
+    if g_log is None:
+        return
+    g_log[0].put(None)
+    g_log[1].join()
+    g_log = None
+    return
+
+def util_log_open ( fname ):
+    """Starts a thread which appends messages queued by util_log_write to a log file"""
+
+    import Queue
+    import threading
+    global g_log
+    util_log_close()
+    messages = Queue.Queue(g_log_queue_size)
+    dropped = [0]
+    t = threading.Thread(target=util_log_thread, args=(fname, messages, dropped))
+    t.daemon = True
+    t.start()
+    g_log = [messages, t, fname, dropped]
+    return
+
+def util_log_rotate ( f, fname ):
+    """Returns the log file open for appending, after renaming it to .1 once it has grown to g_log_size bytes"""
+
+    # processes sharing the log rotate it under an exclusive lock, and the others then reopen it
+    import fcntl
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        t = os.stat(fname)
+        t2 = os.fstat(f.fileno())
+        if (t.st_ino == t2.st_ino) and (t.st_dev == t2.st_dev) and (t.st_size >= g_log_size):
+            for i in range(g_log_rotate_max - 1, 0, -1):
+                if os.path.exists(fname + '.' + str(i)):
+                    os.rename(fname + '.' + str(i), fname + '.' + str(i + 1))
+            os.rename(fname, fname + '.1')
+    except OSError:
+        pass
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    try:
+        t = os.stat(fname)
+        t2 = os.fstat(f.fileno())
+        if (t.st_ino == t2.st_ino) and (t.st_dev == t2.st_dev):
+            return f
+    except OSError:
+        pass
+    f.close()
+    return open(fname, 'a')
+
+def util_log_thread ( fname, messages, dropped ):
+    """Appends queued messages to a log file until None is queued, flushing and rotating it g_log_flush_interval seconds after the first unflushed message"""
+
+    # the deadline and size are checked after every message as well, so that a log which is never idle is still flushed
+    # and rotated
+    import Queue
+    f = open(fname, 'a')
+    deadline = None
+    while True:
+        x = False
+        try:
+            if deadline is None:
+                x = messages.get()
+            else:
+                x = messages.get(True, max(0, deadline - time.time()))
+        except Queue.Empty:
+            pass
+        if x:
+            f.write(util_timestamp(x[0]) + ', ' + x[1] + ': ' + x[2] + '\n')
+            if deadline is None:
+                deadline = time.time() + g_log_flush_interval
+        if (x is None) or ((deadline is not None) and (time.time() >= deadline)) or (f.tell() >= g_log_size):
+            if (dropped[0] > 0):
+                f.write(util_timestamp() + ', log: ' + str(dropped[0]) + ' messages dropped\n')
+                dropped[0] = 0
+            f.flush()
+            f = util_log_rotate(f, fname)
+            deadline = None
+        if x is None:
+            break
+    f.close()
+    return
+
+def util_log_write ( fname, location, message ):
+    """Queues a short message for the log writer of a log file, which adds the time it was queued, or appends it to the log file if no log writer is running"""
+
+    # a message waits at most g_log_timeout seconds for room in a full queue, then is dropped and counted
+    import Queue
+    if (g_log is None) or (g_log[2] != fname):
+        f = open(fname, 'a')
+        f.write(util_timestamp() + ', ' + location + ': ' + message + '\n')
+        f.close()
+        return
+    try:
+        g_log[0].put((time.time(), location, message), True, g_log_timeout)
+    except Queue.Full:
+        g_log[3][0] += 1
+    return
+
+def util_reopen ( f ):
+    """Moves an open file over to the file now at its path, for reading and appending"""
+
+    t = os.open(f.name, os.O_RDWR | os.O_APPEND)
+    os.dup2(t, f.fileno())
+    os.close(t)
+    return
+
+def util_retention_age ( name ):
+    """Returns the maximum age in seconds of rotated files of a data set, where 0 disables the limit"""
+
+    return g_rotate_policies.get(name, {}).get('age', g_retention_age)
+
+def util_retention_due ( ):
+    """Returns boolean for whether retention is configured and has not run for g_retention_interval seconds, marking it as run"""
+
+    # the time of the last run is the modification time of a stamp file, so that short lived processes can share it
+    if not (g_retention_age or g_retention_budget or [x for x in g_rotate_policies.values() if x.get('age')]):
+        return False
+    fname = g_file_path_root + g_retention_stamp
+    t = time.time()
+    try:
+        if ((t - os.path.getmtime(fname)) < g_retention_interval):
+            return False
+    except OSError:
+        pass
+    try:
+        open(fname, 'a').close()
+        os.utime(fname, None)
+    except:
+        raise DiskError(fname)
+    return True
+
+def util_retention_run ( ):
+    """Runs retention if it is due"""
+
+    # called by the daemon writer and the server rather than by adds, which would wait on a pass over all data sets
+    # retention failures are left for the next run rather than failing an add whose rows are written
+    try:
+        if util_retention_due():
+            retention()
+    except Error:
+        pass
+    return
+
+def util_rotate_policy ( name ):
+    """Returns the (size, interval, rows) rotation policy of a data set, where 0 disables a limit"""
+
+    t = g_rotate_policies.get(name, {})
+    return t.get('size', g_rotate_size), t.get('interval', g_rotate_interval), t.get('rows', g_rotate_rows)
+
+def util_row_pad ( row, n ):
+    """Returns a row extended with empty values to n columns"""
+
+    if (len(row) < n):
+        row.extend([''] * (n - len(row)))
+    return row
+
+def util_row_unixtime ( line ):
+    """Returns unix time of a data set line"""
+
+    #unixtime is assumed to be key 1
+    return long(line.split(g_file_delimiter, 1)[0])
+  
+def util_rows ( lines, begin, end ):
+    """Yields rows parsed from data set lines with unix time between begin and end"""
+
+    csv = util_csv()
+    r = csv.reader(lines, dialect=g_file_dialect)
+    for row in r:
+        #unixtime is assumed to be key 1
+        unixtime = long(row[0])
+        if (begin <= unixtime <= end):
+            yield row
+  
+def util_schema_line ( schema, reserve ):
+    """Returns the line representing a schema in a data set, padded by reserve bytes"""
+
+    from cStringIO import StringIO
+    csv = util_csv()
+
+    # padding is a blank last key, i.e. a delimiter followed by spaces
+    b = StringIO()
+    w = csv.writer(b, dialect=g_file_dialect)
+    w.writerow(schema)
+    t = b.getvalue()[:-len(g_file_line_terminator)]
+    if (reserve > 0):
+        t += g_file_delimiter + ' ' * (reserve - 1)
+    return t + g_file_line_terminator
+
+def util_timestamp ( t=None ):
+    """Return a timestamp string for a time in seconds, by default now"""
  
-    # return as YYYYY-MM-DD HH:MM:SS.MMMMMM
-    ct = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f') + ' ' + time.strftime('%Z')
+    from datetime import datetime
+
+    # return as YYYYY-MM-DD HH:MM:SS.MMMMMM, with the time zone name formatted at most every quarter hour
+    if t is None:
+        t = time.time()
+    ct = datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f') + ' ' + util_timestamp_zone()
     return ct
 
 def util_timestamp_format ( unixtime ):
     """Returns as string a human-readable time stamp from unix time in microseconds"""
    
-    # return as YYYY-MM-DD HH:MM:SS.MMMMMM
-    t = float(unixtime) / 1000000
-    t2 = datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f') + ' ' + time.strftime('%Z')
-    return t2
+    # return as YYYY-MM-DD HH:MM:SS.MMMMMM, formatting each whole second once; threads share the cache under a lock
+    global g_timestamp_cache, g_timestamp_cache_last
+    try:
+        seconds, microseconds = divmod(long(unixtime), 1000000)
+    except ValueError:
+        from datetime import datetime
+        t = float(unixtime) / 1000000
+        return datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f') + ' ' + util_timestamp_zone()
+    last = g_timestamp_cache_last
+    if (seconds != last[0]):
+        with g_timestamp_cache_lock:
+            if g_timestamp_cache is None:
+                from collections import OrderedDict
+                g_timestamp_cache = OrderedDict()
+            try:
+                t = g_timestamp_cache.pop(seconds)
+            except KeyError:
+                from datetime import datetime
+                t = datetime.fromtimestamp(seconds).strftime('%Y-%m-%d %H:%M:%S')
+                while (len(g_timestamp_cache) >= g_timestamp_cache_size):
+                    g_timestamp_cache.popitem(last=False)
+            g_timestamp_cache[seconds] = t
+        last = (seconds, t)
+        g_timestamp_cache_last = last
+    return '%s.%06d %s' % (last[1], microseconds, util_timestamp_zone())
 
 def util_timestamp_unix ( ):
     """Returns as string the current time as unix time in microseconds"""
@@ -482,32 +1616,211 @@ def util_timestamp_unix ( ):
     t2 = str(t)
     return t2
 
+def util_timestamp_zone ( ):
+    """Returns the current time zone name"""
+
+    # re-read at most every quarter hour, so as to follow daylight saving changes
+    global g_timestamp_zone, g_timestamp_zone_expiry
+    t = time.time()
+    if (t >= g_timestamp_zone_expiry):
+        g_timestamp_zone = time.strftime('%Z')
+        g_timestamp_zone_expiry = (long(t) // 900 + 1) * 900
+    return g_timestamp_zone
+
 def util_values_clean ( values ):
     """Returns an escaped list of strings that are valid utf-8"""
   
+    # patterns are anything other than printable ascii, then (1) escapable text, (2) runs of valid 
+    # utf-8 sequences, (3) any other non-ascii byte
+    global g_re_values_clean, g_re_values_special
+    if g_re_values_clean is None:
+        escapes = [i for i in sorted(g_file_escapechars, key=len, reverse=True) if i != g_file_escapechars[i]]
+        g_re_values_special = re.compile(r'[^\x20-\x7e]' + ''.join(['|' + re.escape(i) for i in escapes]))
+        g_re_values_clean = re.compile('(' + '|'.join([re.escape(i) for i in escapes]) + ')|' +
+            r'((?:[\xc2-\xdf][\x80-\xbf]|\xe0[\xa0-\xbf][\x80-\xbf]|[\xe1-\xef][\x80-\xbf]{2}|\xf0[\x90-\xbf][\x80-\xbf]{2}|[\xf1-\xf3][\x80-\xbf]{3}|\xf4[\x80-\x8f][\x80-\xbf]{2})+)|' +
+            r'([\x80-\xff])')
+
+    # rows of printable ascii, which covers most metrics, are returned as is
+    try:
+        if g_re_values_special.search(g_file_delimiter.join(values)) is None:
+            return [str(i) for i in values]
+    except (TypeError, UnicodeError):
+        pass
+
+    # otherwise escape control characters, keep valid utf-8 sequences, and strip other bytes in one pass
     new_values = []
     for i in values:
-        for j, k in g_file_escapechars.items():
-            i = i.replace(j, k)
-        i = i.decode('utf-8','ignore').encode("utf-8")
-        new_values.append(i)
+        if isinstance(i, unicode):
+            i = i.encode('utf-8')
+        elif not isinstance(i, str):
+            i = str(i)
+        new_values.append(g_re_values_clean.sub(util_values_clean_match, i))
     return new_values
 
+def util_values_clean_match ( m ):
+    """Returns the replacement for a match of util_values_clean"""
+
+    if m.lastindex == 1:
+        return g_file_escapechars[m.group(1)]
+    if m.lastindex == 2:
+        return m.group(2)
+    return ''
+
+def util_values_mapper ( schema, keys ):
+    """Returns a function which orders a list of values for keys to the schema"""
+
+    import operator
+
+    # positions of the first occurrence of each key, with missing keys gathered from an empty value past the end
+    positions = {}
+    for i, j in enumerate(keys):
+        positions.setdefault(j, i)
+    missing = len(keys)
+    indexes = [positions.get(i, missing) for i in schema]
+    if (indexes == range(len(keys))):
+        return list
+    gather = operator.itemgetter(*indexes)
+    if (len(indexes) == 1):
+        return lambda values: [(values + [''])[indexes[0]]]
+    if (missing in indexes):
+        return lambda values: list(gather(values + ['']))
+    return lambda values: list(gather(values))
+
 def util_values_order ( schema, keys, values ):
     """Returns a list ordered to the schema"""
     
-    new_values = []
-    for i in schema:
-        found_key = False
-        for j in keys:
-            if i == j:
-                item = values[keys.index(j)]
-                found_key = True
-        if found_key:
-            new_values.append(item)
-        else:
-            new_values.append('')
-    return new_values
+    return util_values_mapper(schema, keys)(values)
+
+def util_write ( fd, data ):
+    """Writes a string to a file descriptor, in one system call unless the system writes less"""
+
+    n = os.write(fd, data)
+    while (n < len(data)):
+        n += os.write(fd, data[n:])
+    return
+
+
+# daemon oriented functions
+
+def daemon_dataset ( datasets, name, keys ):
+    """Returns an open data set and its schema from the daemon cache, opening it as needed"""
+
+    # entries are [file, schema, size after last write]; reopen after rotation or removal by other
+    # processes, and re-read the schema after writes by other processes
+    fname = ds_filename(name)
+    entry = datasets.get(name)
+    if entry is not None:
+        try:
+            t = os.stat(fname)
+            t2 = os.fstat(entry[0].fileno())
+            if (t.st_ino != t2.st_ino) or (t.st_dev != t2.st_dev):
+                raise OSError
+            if (t.st_size != entry[2]):
+                entry[1] = ds_schema_read(entry[0])
+        except OSError:
+            entry[0].close()
+            entry = None
+    if entry is None:
+        if (len(datasets) >= g_daemon_open_max):
+            daemon_close(datasets)
+        f = ds_open(fname, keys)
+        entry = [f, ds_schema_read(f), None]
+        datasets[name] = entry
+    return entry
+
+def daemon_close ( datasets ):
+    """Closes all data sets in the daemon cache"""
+
+    for name in datasets.keys():
+        datasets.pop(name)[0].close()
+    return
+
+def daemon_handle ( s, address, server ):
+    """Handles a JSON string forwarded by a client"""
+
+    import json
+    import threading
+    f = s.makefile('rb')
+    data = f.read()
+    f.close()
+    try:
+        try: 
+            t = json.loads(data, strict=False)
+        except ValueError:
+            raise BadJsonError(data)
+        name, keys, values = util_document_prepare(t)
+        request = [name, keys, values, threading.Event(), None]
+        server.requests.put(request)
+        request[3].wait()
+        result = request[4]
+    except Error as e:
+        result = e
+    if isinstance(result, Error):
+        t = '1' + g_file_delimiter + result.description
+    else:
+        t = '0' + g_file_delimiter + str(result[0]) + g_file_delimiter + result[1]
+    s.sendall(t + g_file_line_terminator)
+    return
+
+def daemon_server ( address ):
+    """Returns a threaded unix socket server for the ingest daemon, which queues requests for a single writer"""
+
+    import Queue
+    import SocketServer
+
+    class DaemonServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+    server = DaemonServer(address, daemon_handle)
+    server.requests = Queue.Queue()
+    return server
+
+def daemon_write ( requests, datasets ):
+    """Writes requests queued by daemon handlers in batches, one batch per data set"""
+
+    # requests are [name, keys, values, event, result], where result is (rows, name) or an Error
+    import Queue
+    while True:
+        # requests queued while the previous batch was written join this one, without waiting for more
+        batch = [requests.get()]
+        while True:
+            try:
+                batch.append(requests.get_nowait())
+            except Queue.Empty:
+                break
+
+        names = []
+        for x in batch:
+            if x[0] not in names:
+                names.append(x[0])
+        for name in names:
+            items = [x for x in batch if x[0] == name]
+            try:
+                entry = daemon_dataset(datasets, name, items[0][1])
+                if g_rotate:
+                    ds_rotate(entry[0], name, max([long(y[0]) for x in items for y in x[2]]))
+                for x in items:
+                    n, entry[1] = ds_append(entry[0], entry[1], x[1], x[2])
+                    x[4] = (n, name)
+                entry[0].flush()
+                entry[2] = os.fstat(entry[0].fileno()).st_size
+            except Error as e:
+                for x in items:
+                    if x[4] is None:
+                        x[4] = e
+            except:
+                entry = datasets.pop(name, None)
+                if entry is not None:
+                    entry[0].close()
+                for x in items:
+                    if x[4] is None:
+                        x[4] = DiskError(ds_filename(name))
+
+        for x in batch:
+            x[3].set()
+            requests.task_done()
+        util_retention_run()
+    return
 
 
 # high-level functions
@@ -515,36 +1828,99 @@ def util_values_order ( schema, keys, values ):
 def add ( data ):
     """Process JSON string to add to data set"""
     
-    if util_json_bad(data):
+    import json
+    try: 
+        t = json.loads(data, strict=False)
+    except ValueError:
         raise BadJsonError(data)
         return
 
-    t = json.loads(data, strict=False)
-    name = t["dataset"]
-    keys = t["keys"]
-    values = t["values"]
+    return add_document(t)
 
-    if util_key_bad(keys):
-        raise BadKeysError(str(keys))
-        return
+def add_document ( t ):
+    """Process parsed JSON document to add to data set"""
 
-    util_keys_values_add_time(keys, values)
+    name, keys, values = util_document_prepare(t)
+    n = add_values(name, keys, values)
+    return n, name
+
+def add_lines ( lines ):
+    """Process newline-delimited JSON strings, for any number of data sets, to add to data sets.  Returns list of (rows, name), one per data set, where rows is an Error for a data set not added"""
+
+    # nothing is added unless all documents are valid, then each data set is added whether or not others fail
+    result = []
+    for name, keys, values in util_lines_prepare(lines):
+        try:
+            result.append((add_values(name, keys, values), name))
+        except Error as e:
+            result.append((e, name))
+    return result
+
+def add_values ( name, keys, values ):
+    """Adds values for keys, which include unixtime and timestamp, to a data set.  Returns number of rows"""
 
+    lock = util_dataset_lock(name)
+    if lock is not None:
+        lock.acquire()
     try:
         fname = ds_filename(name)
-        new_dataset = not(ds_exists(fname))
-        if new_dataset:
-            f = open(fname, 'w') 
-            ds_create(f, keys)
-            f.close()
-        f = open(fname, 'r+') 
-        n = ds_write(f, keys, values)
-        f.close()
+        # rotate before writing, so that rows of a new time interval start a new file
+        f = ds_open(fname, keys)
         if g_rotate:
-            ds_rotate(name)
+            ds_rotate(f, name, max([long(x[0]) for x in values]))
+        n, schema = ds_append(f, ds_schema_read(f), keys, values)
+        f.close()
     except Exception as e:
         raise DiskError(fname)
-    return n, name
+    finally:
+        if lock is not None:
+            lock.release()
+    return n
+
+def client ( data ):
+    """Forward JSON string to the ingest daemon to add to data set, or add it directly if no daemon is listening"""
+
+    s = util_daemon_connect(g_daemon_socket)
+    if s is None:
+        return add(data)
+    return util_daemon_send(s, g_daemon_socket, data)
+
+def daemon ( ):
+    """Listen on g_daemon_socket for JSON strings to add to data sets, until interrupted"""
+
+    try:
+        if os.path.exists(g_daemon_socket):
+            os.remove(g_daemon_socket)
+        server = daemon_server(g_daemon_socket)
+    except:
+        raise DiskError(g_daemon_socket)
+
+    import signal
+    import threading
+    writer = threading.Thread(target=daemon_write, args=(server.requests, {}))
+    writer.daemon = True
+    writer.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(g_daemon_socket)
+        # let the writer finish queued requests
+        server.requests.join()
+    return
+
+def compact ( name, unique ):
+    """Sorts the rows of the rotated files of a data set by unix time, optionally without duplicates.  Returns number of rows and files"""
+
+    fname = ds_filename(name)
+    if not ds_exists(fname):
+        raise BadDatasetError(name)
+        return
+
+    size = util_rotate_policy(name)[0] or g_rotate_size
+    n = ds_compact(fname, size, unique)
+    return n, len(ds_manifest_read(fname))
 
 def delete ( name ):
     """Removes a data set"""
@@ -554,12 +1930,25 @@ def delete ( name ):
         raise BadDatasetError(name)
         return
 
+    # rotated files go before the manifest which lists them, so that none is left behind unlisted
+    for x in ds_manifest_read(fname):
+        ds_segment_delete(fname + '.' + x[0])
+    if ds_exists(ds_manifest_filename(fname)):
+        ds_delete(ds_manifest_filename(fname))
     ds_delete(fname)
+    if ds_exists(ds_index_filename(fname)):
+        ds_delete(ds_index_filename(fname))
     return
     
 def query ( name, time_min, time_max ):
     """Return a JSON document based on values matching query parameters"""
 
+    fragments = list(query_iter(name, time_min, time_max))
+    return len(fragments) - 2, ''.join(fragments)
+
+def query_iter ( name, time_min, time_max ):
+    """Return a generator of JSON document fragments based on values matching query parameters"""
+
     if not (util_is_int(time_min) and util_is_int(time_max)):
         raise BadQueryError(name, time_min, time_max)
         return
@@ -573,11 +1962,9 @@ def query ( name, time_min, time_max ):
 
     try:
         f = open(fname, 'r') 
-        n, output = ds_query(f, name, long(time_min), long(time_max), True)
-        f.close()
-    except Exception as e:
+    except:
         raise DiskError(fname)
-    return n, output
+    return util_iter_close(f, ds_query_iter(f, name, long(time_min), long(time_max), True))
 
 def rename ( name_from, name_to ):
     """Renames a data set"""
@@ -591,12 +1978,109 @@ def rename ( name_from, name_to ):
         raise BadDatasetError(name_to)
         return
 
+    # rotated files are listed in the manifest by suffix, so they keep their suffixes under the new name
+    for x in ds_manifest_read(fname_from):
+        ds_segment_rename(fname_from + '.' + x[0], fname_to + '.' + x[0])
+    if ds_exists(ds_manifest_filename(fname_from)):
+        ds_rename(ds_manifest_filename(fname_from), ds_manifest_filename(fname_to))
     ds_rename(fname_from, fname_to)
+    if ds_exists(ds_index_filename(fname_from)):
+        ds_rename(ds_index_filename(fname_from), ds_index_filename(fname_to))
     return
     
+def retention ( ):
+    """Removes rotated files older than the maximum age of their data set, then the oldest rotated files of all data sets beyond the disk budget.  Returns number of files removed"""
+
+    # rotated files are found through manifests, and dated by the unix time of their last row or else by modification time
+    try:
+        names = sorted(os.listdir(g_file_path_root))
+    except:
+        raise DiskError(g_file_path_root)
+    now = long(time.time() * 1000000)
+    segments = []
+    total = 0
+    n = 0
+    for x in names:
+        if not x.endswith(g_manifest_extension):
+            continue
+        fname = g_file_path_root + x[:-len(g_manifest_extension)]
+        age = util_retention_age(x[:len(x) - len(g_manifest_extension) - len(g_file_extension)])
+        expired = []
+        for y in ds_manifest_read(fname):
+            size, mtime = ds_segment_stat(fname + '.' + y[0])
+            if (mtime is None):
+                continue
+            unixtime = y[2]
+            if (unixtime is None):
+                unixtime = long(mtime * 1000000)
+            if (age > 0) and (unixtime < (now - age * 1000000)):
+                expired.append(y[0])
+            else:
+                segments.append((unixtime, fname, y[0], size))
+                total += size
+        for y in [fname, ds_index_filename(fname)]:
+            if os.path.isfile(y):
+                total += os.path.getsize(y)
+        if expired:
+            ds_expire(fname, expired)
+            n += len(expired)
+
+    # the data set files themselves count toward the budget, but are never removed
+    if (g_retention_budget > 0) and (total > g_retention_budget):
+        expired = {}
+        for x in sorted(segments):
+            if (total <= g_retention_budget):
+                break
+            expired.setdefault(x[1], []).append(x[2])
+            total -= x[3]
+        for x in sorted(expired):
+            ds_expire(x, expired[x])
+            n += len(expired[x])
+    return n
+
 def upload ( name, time_min, time_max, host, port ):
     """Uploads the content of a query to a remote node"""
 
+    n, data = upload_query(name, time_min, time_max)
+    if (n > 0):
+        util_http_put(host, port, g_http_url_add, data)
+    return n
+
+def upload_bulk ( queries, host, port ):
+    """Uploads the content of queries, as (name, time_min, time_max), to a remote node in one request.  Returns list of number of rows, or an Error for a query not uploaded, one per query"""
+
+    # documents are sent as newline-delimited JSON, and the remote node reports rows or an error for each data set
+    import json
+    result = []
+    documents = []
+    for name, time_min, time_max in queries:
+        try:
+            n, data = upload_query(name, time_min, time_max)
+        except Error as e:
+            result.append(e)
+            continue
+        result.append(n)
+        if (n > 0):
+            documents.append(data)
+    if not documents:
+        return result
+
+    response = util_http_put(host, port, g_http_url_add_bulk, '\n'.join(documents) + '\n')
+    try:
+        reports = dict([(x['dataset'], x) for x in json.loads(response)['results']])
+    except (ValueError, KeyError, TypeError):
+        raise UploadError(response)
+    for i, x in enumerate(queries):
+        if isinstance(result[i], Error) or (result[i] == 0):
+            continue
+        report = reports.get(x[0], { 'error' : 'no result for dataset ' + x[0] })
+        if 'error' in report:
+            result[i] = UploadError(report['error'])
+    return result
+
+def upload_query ( name, time_min, time_max ):
+    """Returns number of rows and the JSON document of a query to upload, which leaves out timestamps"""
+
     if not (util_is_int(time_min) and util_is_int(time_max)):
         raise BadQueryError(name, time_min, time_max)
         return
@@ -611,22 +2095,7 @@ def upload ( name, time_min, time_max, host, port ):
     f = open(fname, 'r') 
     n, data = ds_query(f, name, long(time_min), long(time_max), False)
     f.close()
-
-    if (n > 0):
-        url = 'http://' + host + ':' + port + g_http_url_add
-        proxy_handler = urllib2.ProxyHandler(g_http_proxies)
-        opener = urllib2.build_opener(proxy_handler)
-        header = {}
-        header['Content-Type'] = 'application/json'
-        request = urllib2.Request(url, data, header)
-        request.get_method = lambda: 'PUT'
-        try:
-            f = opener.open(request)
-            response = f.read()
-            f.close()
-        except:
-            raise NetworkError(url)
-    return n
+    return n, data
 
     
 # main starts here...
@@ -645,20 +2114,62 @@ def util_success ( f, location, message ):
     f.write(t)
     return
 
+class Arguments(object):
+    """Command line arguments, as parsed by util_args_fast"""
+
+    def __init__(self):
+        self.add = self.compact = self.delete = self.file = self.logfile = self.query = self.rename = self.upload = None
+        self.client = self.daemon = self.retention = self.unique = self.verbose = False
+
+def util_args_fast ( argv ):
+    """Returns arguments for the plain forms of add without loading argparse, or None"""
+
+    # -a JSON or -f FILE, optionally with -c, -v and -l FILE; anything else is left to argparse
+    options = {'-a' : 'add', '--add' : 'add', '-f' : 'file', '--file' : 'file', '-l' : 'logfile', '--logfile' : 'logfile'}
+    args = Arguments()
+    i = 0
+    while (i < len(argv)):
+        x = argv[i]
+        if x in ['-c', '--client']:
+            args.client = True
+        elif x in ['-v', '--verbose']:
+            args.verbose = True
+        elif x in options:
+            i += 1
+            if (i >= len(argv)) or argv[i].startswith('-'):
+                return None
+            setattr(args, options[x], [argv[i]])
+        else:
+            return None
+        i += 1
+    if not (args.add or args.file):
+        return None
+    return args
+
 if __name__ == '__main__':
 
-    # define command line argument parser
-    d = 'Cronbook. Time series data processor. JSON format is {"dataset":"name", "keys":["key_1","key_n"], "values":[["value_1","value_n"]]}'
-    parser = argparse.ArgumentParser(description = d)
-    parser.add_argument('-a', '--add', nargs=1, help='add via inline JSON string', metavar=('JSON'))
-    parser.add_argument('-d', '--delete', nargs=1, help='delete dataset', metavar=('NAME'))
-    parser.add_argument('-f', '--file', nargs=1, help='add via JSON file', metavar=('FILE'))
-    parser.add_argument('-l', '--logfile', nargs=1, help='write output to file', metavar=('FILE'))
-    parser.add_argument('-q', '--query', nargs=3, help='query dataset', metavar=('NAME', 'MIN', 'MAX'))
-    parser.add_argument('-r', '--rename', nargs=2, help='rename dataset', metavar=('NAME_FROM', 'NAME_TO'))
-    parser.add_argument('-u', '--upload', nargs=5, help='upload dataset', metavar=('NAME', 'MIN', 'MAX', 'HOST', 'PORT'))
-    parser.add_argument('-v', '--verbose', help='verbose output', action='store_true')
-    args = parser.parse_args()
+    # plain adds, the bulk of all invocations, skip loading argparse
+    args = util_args_fast(sys.argv[1:])
+    if args is None:
+        import argparse
+
+        # define command line argument parser
+        d = 'Cronbook. Time series data processor. JSON format is {"dataset":"name", "keys":["key_1","key_n"], "values":[["value_1","value_n"]]}'
+        parser = argparse.ArgumentParser(description = d)
+        parser.add_argument('-a', '--add', nargs=1, help='add via inline JSON string', metavar=('JSON'))
+        parser.add_argument('-c', '--client', help='add via the ingest daemon, if listening', action='store_true')
+        parser.add_argument('-C', '--compact', nargs=1, help='sort rotated files of dataset by time', metavar=('NAME'))
+        parser.add_argument('-d', '--delete', nargs=1, help='delete dataset', metavar=('NAME'))
+        parser.add_argument('-D', '--daemon', help='run the ingest daemon', action='store_true')
+        parser.add_argument('-f', '--file', nargs=1, help='add via JSON file', metavar=('FILE'))
+        parser.add_argument('-l', '--logfile', nargs=1, help='write output to file', metavar=('FILE'))
+        parser.add_argument('-q', '--query', nargs=3, help='query dataset', metavar=('NAME', 'MIN', 'MAX'))
+        parser.add_argument('-r', '--rename', nargs=2, help='rename dataset', metavar=('NAME_FROM', 'NAME_TO'))
+        parser.add_argument('-R', '--retention', help='remove rotated files beyond their maximum age or the disk budget', action='store_true')
+        parser.add_argument('-U', '--unique', help='with compact, drop duplicate rows', action='store_true')
+        parser.add_argument('-u', '--upload', nargs=5, help='upload dataset', metavar=('NAME', 'MIN', 'MAX', 'HOST', 'PORT'))
+        parser.add_argument('-v', '--verbose', help='verbose output', action='store_true')
+        args = parser.parse_args()
 
     if args.logfile:
         function = 'logfile'
@@ -675,7 +2186,10 @@ if __name__ == '__main__':
     if args.add:
         function = 'add'
         try:
-            n, dataset = add(args.add[0])
+            if args.client:
+                n, dataset = client(args.add[0])
+            else:
+                n, dataset = add(args.add[0])
             if args.verbose:
                 t = str(n) + ' sets added to dataset ' + dataset
                 util_success(f_success, function, t)
@@ -684,6 +2198,33 @@ if __name__ == '__main__':
             sys.exit(1)
         sys.exit(0)
 
+    if args.compact:
+        function = 'compact'
+        try:
+            n, files = compact(args.compact[0], args.unique)
+            if args.verbose:
+                t = str(n) + ' sets of dataset ' + args.compact[0] + ' sorted into ' + str(files) + ' rotated files'
+                util_success(f_success, function, t)
+        except Error as e: 
+            util_error(f_error, function, e.description)
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.daemon:
+        function = 'daemon'
+        try:
+            if args.verbose:
+                util_success(f_success, function, 'listening on ' + g_daemon_socket)
+            daemon()
+        except Error as e: 
+            util_error(f_error, function, e.description)
+            sys.exit(1)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        if args.verbose:
+            util_success(f_success, function, 'stopped')
+        sys.exit(0)
+
     if args.delete:
         function = 'delete'
         try:
@@ -708,7 +2249,10 @@ if __name__ == '__main__':
             sys.exit(1)
 
         try:
-            n, dataset = add(content)
+            if args.client:
+                n, dataset = client(content)
+            else:
+                n, dataset = add(content)
             if args.verbose:
                 t = str(n) + ' sets added to dataset ' + dataset
                 util_success(f_success, function, t)
@@ -720,12 +2264,10 @@ if __name__ == '__main__':
     if args.query:
         function = 'query'
         try:
-            n, output = query(args.query[0], args.query[1], args.query[2])
+            n = util_fragments_write(sys.stdout, query_iter(args.query[0], args.query[1], args.query[2]))
             if args.verbose:
                 t = str(n) + ' sets returned via query ' + args.query[0] + ' from ' + args.query[1] + ' to ' + args.query[2] 
                 util_success(f_success, function, t)
-            if (n > 0):
-                print output
         except Error as e: 
             util_error(f_error, function, e.description)
             sys.exit(1)
@@ -743,6 +2285,18 @@ if __name__ == '__main__':
             sys.exit(1)
         sys.exit(0)
 
+    if args.retention:
+        function = 'retention'
+        try:
+            n = retention()
+            if args.verbose:
+                t = str(n) + ' rotated files removed'
+                util_success(f_success, function, t)
+        except Error as e: 
+            util_error(f_error, function, e.description)
+            sys.exit(1)
+        sys.exit(0)
+
     if args.upload:
         function = 'upload'
         try:
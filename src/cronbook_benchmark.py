@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+# cronbook_benchmark.py
+# Britton Fraley
+# 2016-04-10
+
+# ------------------------------------------------------------------------------
+# This script measures the performance of selected functions of cronbook.py
+# ------------------------------------------------------------------------------
+
+# dependencies
+import argparse
+import cronbook
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+# globals
+g_repeat = 5
+g_rows = 5000
+g_startup_runs = 20
+g_writer_adds = 200
+g_writer_rows = 10
+
+# runs a script as __main__, then reports the number of modules loaded to stderr
+g_startup_wrapper = '''
+import sys
+sys.argv = sys.argv[1:]
+try:
+    execfile(sys.argv[0], {'__name__' : '__main__', '__file__' : sys.argv[0]})
+finally:
+    sys.stderr.write('\\nmodules %d\\n' % len([x for x in sys.modules.values() if x is not None]))
+'''
+
+def bench_startup ( ):
+    """Report wall time and modules loaded for each command line function of cronbook.py"""
+
+    # run a copy of cronbook.py which stores its data sets in a temporary directory
+    path = tempfile.mkdtemp()
+    script = os.path.join(path, 'cronbook.py')
+    t = open(os.path.splitext(cronbook.__file__)[0] + '.py').read()
+    for x in ['g_file_path_root', 'g_daemon_socket']:
+        t = t.replace(x + ' = \'/home/mylogin/log/', x + ' = \'' + path + '/')
+    open(script, 'w').write(t)
+    empty = os.path.join(path, 'empty.py')
+    open(empty, 'w').close()
+    document = '{ "dataset" : "startup", "keys" : [ "key_1", "key_2" ], "values" : [ [ "value_1", "value_2" ] ] }'
+    open(os.path.join(path, 'document'), 'w').write(document)
+
+    commands = [
+        ('python', [empty]),
+        ('add', [script, '-a', document]),
+        ('add file', [script, '-f', os.path.join(path, 'document')]),
+        ('add client, no daemon', [script, '-c', '-a', document]),
+        ('add client', [script, '-c', '-a', document]),
+        ('query', [script, '-q', 'startup', '0', '9999999999999999']),
+        ('upload, no rows', [script, '-u', 'startup', '0', '0', 'localhost', '8080']),
+        ('rename', [script, '-r', 'startup_none', 'startup_other']),
+        ('delete', [script, '-d', 'startup_none']),
+        ('help', [script, '-h'])
+    ]
+    sys.stdout.write('%-32s %11s %11s\n' % ('command', 'wall', 'modules'))
+    daemon = None
+    try:
+        for label, args in commands:
+            if (label == 'add client'):
+                daemon = subprocess.Popen([sys.executable, script, '-D'])
+                while not os.path.exists(os.path.join(path, 'cronbook_socket')):
+                    time.sleep(0.01)
+            times = []
+            for i in range(g_startup_runs):
+                t = time.time()
+                subprocess.call([sys.executable] + args, stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+                times.append(time.time() - t)
+            p = subprocess.Popen([sys.executable, '-c', g_startup_wrapper] + args, stdout=open(os.devnull, 'w'), stderr=subprocess.PIPE)
+            modules = p.communicate()[1].split()[-1]
+            times.sort()
+            sys.stdout.write('%-32s %8.1f ms %11s\n' % (label, times[len(times) // 2] * 1000, modules))
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        shutil.rmtree(path)
+    return
+
+def bench_values_clean ( ):
+    """Compare util_values_clean with the replace-based implementation it superseded"""
+
+    rows_numeric = [['myhost', 'all', '0.67', '0.00', '0.27', '0.10', '0.00', '0.03', '0.00', '0.00', '98.93']] * g_rows
+    rows_text = [['embedded \ttab', 'embedded \nnewline', 'caf\xc3\xa9', 'abcdefghijk\xa0', '0.00']] * g_rows
+    for label, rows in [('numeric', rows_numeric), ('text', rows_text)]:
+        t_before = util_best(lambda: [util_values_clean_before(x) for x in rows])
+        t_after = util_best(lambda: [cronbook.util_values_clean(x) for x in rows])
+        util_report('util_values_clean ' + label, t_before, t_after)
+    return
+
+def bench_writers ( ):
+    """Report throughput of processes adding to one data set at once, and verify that no rows are lost or mixed up"""
+
+    path = tempfile.mkdtemp()
+    cronbook.g_file_path_root = path + '/'
+    cronbook.g_rotate_max = 100000
+    sys.stdout.write('%-32s %11s %11s\n' % ('writers', 'rows/s', 'rows'))
+    try:
+        for writers in [1, 2, 4, 8]:
+            name = 'writers_' + str(writers)
+            t = time.time()
+            pids = []
+            for i in range(writers):
+                pid = os.fork()
+                if (pid == 0):
+                    try:
+                        for j in range(g_writer_adds):
+                            values = [[str(i), str(j * g_writer_rows + k), 'x' * 100] for k in range(g_writer_rows)]
+                            cronbook.add_document({ 'dataset' : name, 'keys' : ['writer', 'row', 'payload'], 'values' : values })
+                    finally:
+                        os._exit(0)
+                pids.append(pid)
+            for pid in pids:
+                os.waitpid(pid, 0)
+            t = time.time() - t
+
+            f = open(cronbook.ds_filename(name), 'r')
+            found = sorted([(x[2], x[3], x[4]) for x in cronbook.ds_query_segments(f, 0, 9999999999999999)])
+            f.close()
+            expected = sorted([(str(i), str(j), 'x' * 100) for i in range(writers) for j in range(g_writer_adds * g_writer_rows)])
+            result = str(len(found))
+            if (found != expected):
+                result += ' mismatch'
+            sys.stdout.write('%-32s %11d %11s\n' % (str(writers), len(expected) / t, result))
+    finally:
+        shutil.rmtree(path)
+    return
+
+def util_best ( function ):
+    """Returns the best time in seconds of g_repeat runs of a function"""
+
+    return min(timeit.repeat(function, number=1, repeat=g_repeat))
+
+def util_report ( label, t_before, t_after ):
+    """Write a short comparison of two timings"""
+
+    t = '%-32s %8.1f ms %8.1f ms %6.1fx\n' % (label, t_before * 1000, t_after * 1000, t_before / t_after)
+    sys.stdout.write(t)
+    return
+
+def util_values_clean_before ( values ):
+    """Returns an escaped list of strings that are valid utf-8, as previously implemented"""
+
+    new_values = []
+    for i in values:
+        for j, k in cronbook.g_file_escapechars.items():
+            i = i.replace(j, k)
+        i = i.decode('utf-8','ignore').encode("utf-8")
+        new_values.append(i)
+    return new_values
+
+if __name__ == '__main__':
+
+    # define command line argument parser
+    d = 'Cronbook benchmark.'
+    parser = argparse.ArgumentParser(description = d)
+    parser.add_argument('-c', '--clean', help='benchmark value cleaning', action='store_true')
+    parser.add_argument('-s', '--startup', help='benchmark command line startup', action='store_true')
+    parser.add_argument('-w', '--writers', help='benchmark concurrent writers', action='store_true')
+    args = parser.parse_args()
+    everything = (len(sys.argv) == 1)
+
+    if args.clean or everything:
+        sys.stdout.write('%-32s %11s %11s %7s\n' % ('benchmark', 'before', 'after', 'speedup'))
+        bench_values_clean()
+
+    if args.startup or everything:
+        bench_startup()
+
+    if args.writers or everything:
+        bench_writers()
+
+    sys.exit(0)
@@ -47,7 +47,8 @@ def copy ( ):
     time_current = cronbook.util_timestamp_unix() 
     d = shelve.open(g_database)
 
-    # get last timestamp for each dataset and call upload for last to current timestamp
+    # get last timestamp for each dataset and upload all datasets for last to current timestamp in one request
+    queries = []
     for dataset in g_datasets:
         if not d.has_key(dataset):
             time_last = long(0)
@@ -55,8 +56,13 @@ def copy ( ):
         else:
             time_last = long(d[dataset]) 
             time_min = time_last + 1
-        n = cronbook.upload(dataset, time_min, time_current, g_host, g_port)
-        if (n > 0):
+        queries.append((dataset, time_min, time_current))
+    # data sets are recorded one by one, so that those not uploaded are retried next time without the others
+    result = cronbook.upload_bulk(queries, g_host, g_port)
+    for (dataset, time_min, time_max), n in zip(queries, result):
+        if isinstance(n, cronbook.Error):
+            util_error(function, n.description)
+        elif (n > 0):
             d[dataset] = time_current
             t = str(n) + ' sets uploaded via query ' + dataset + ' from ' + str(time_min) + ' to ' + str(time_current)  + ' to server ' + g_host + ' on port ' + g_port
             util_success(function, t)
@@ -67,23 +73,18 @@ def copy ( ):
 def util_error ( location, message ):
     """Write a short error message"""
 
-    t = cronbook.util_timestamp() + ', ' + location + ': ' + message + '\n'
-    f = open(g_file_server_log, 'a')
-    f.write(t)
-    f.close()
+    cronbook.util_log_write(g_file_server_log, location, message)
     return
 
 def util_success ( location, message ):
     """Write a short success message"""
 
-    t = cronbook.util_timestamp() + ', ' + location + ': ' + message + '\n'
-    f = open(g_file_server_log, 'a')
-    f.write(t)
-    f.close()
+    cronbook.util_log_write(g_file_server_log, location, message)
     return
 
 if __name__ == '__main__':
 
+    cronbook.util_log_open(g_file_server_log)
     util_success('main', 'copier started')
 
     # define command line argument parser
@@ -99,11 +100,14 @@ if __name__ == '__main__':
         except cronbook.Error as e: 
             util_error(function, e.description)
             util_success('main', 'copier stopped')
+            cronbook.util_log_close()
             sys.exit(1)
         except Error as e: 
             util_error(function, e.description)
             util_success('main', 'copier stopped')
+            cronbook.util_log_close()
             sys.exit(1)
 
     util_success('main', 'copier stopped')
+    cronbook.util_log_close()
     sys.exit(0)
@@ -9,32 +9,79 @@
 # ------------------------------------------------------------------------------
 
 # dependencies
-from bottle import route, run, request, abort
+from bottle import route, run, request, response, abort, ServerAdapter
 import cronbook
+import itertools
 import json
 import os
+import Queue
+import signal
 import sys
+import threading
+import time
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+import zlib
 
 # globals
 g_file_server_log = '/home/mylogin/log/cronbook_server_log'
 g_file_server_pid = '/home/mylogin/log/cronbook_server_pid'
 g_host = 'localhost'
 g_port = 8080
+g_query_chunk_size = 65536 # bytes of query results sent at once
+g_threads = 8 # 0 for one thread, which serves requests one at a time
+g_threads_queue = 64 # accepted requests waiting for a thread
 g_url_add = '/cronbook_add'
+g_url_add_bulk = '/cronbook_add_bulk'
 g_url_query = '/cronbook_query'
+g_workers = 0 # processes, each the only writer of its share of data sets; 0 for one process
+g_workers_socket = '/home/mylogin/log/cronbook_server_socket_' # followed by the worker number
+
+class PoolServer(WSGIServer):
+    """WSGI server which queues accepted requests for a pool of threads"""
+
+    def process_request ( self, connection, client_address ):
+        """Queue a request, waiting while the queue is full"""
+
+        self.requests.put((connection, client_address))
+        return
+
+class PoolServerAdapter(ServerAdapter):
+    """Bottle adapter which serves requests with g_threads threads in each of g_workers processes"""
+
+    def run ( self, handler ):
+        """Start the threads, then accept requests until interrupted"""
+
+        server = make_server(self.host, self.port, handler, PoolServer, QuietHandler)
+        if (g_workers > 0):
+            util_workers(server)
+        else:
+            util_serve(server)
+        return
+
+class QuietHandler(WSGIRequestHandler):
+    """Request handler which neither logs requests nor looks up client names"""
+
+    def address_string ( self ):
+        return self.client_address[0]
+
+    def log_request ( self, *args, **kw ):
+        return
 
 @route(g_url_add, method='PUT')
 def put_cronbook_add():
     """Process JSON string to add to data set"""
 
     function = 'add'
-    arg_json = request.body.readline()
+    arg_json = request.body.read()
     if not arg_json:
         t = 'no data received'
         util_error(function, t)
         abort(400, t)
     try:
-        n, dataset = cronbook.add(arg_json)
+        if (g_workers > 0):
+            n, dataset = util_worker_add(arg_json)
+        else:
+            n, dataset = cronbook.add(arg_json)
         t = str(n) + ' sets added to dataset ' + dataset 
         util_success(function, t)
     except cronbook.Error as e: 
@@ -46,18 +93,53 @@ def put_cronbook_add():
         abort(400, t)
     return
 
+@route(g_url_add_bulk, method='PUT')
+def put_cronbook_add_bulk():
+    """Process newline-delimited JSON strings, for any number of data sets, to add to data sets.  Returns a JSON document with rows or an error for each data set"""
+
+    # documents are parsed line by line as the body is read; data sets are reported one by one, so that a client can
+    # retry only those not added
+    function = 'add bulk'
+    try:
+        if (g_workers > 0):
+            result = util_worker_add_lines(request.body)
+        else:
+            result = cronbook.add_lines(request.body)
+    except cronbook.Error as e: 
+        util_error(function, e.description)
+        abort(400, e.description)
+    except:
+        t = 'error' 
+        util_error(function, t)
+        abort(400, t)
+    if not result:
+        t = 'no data received'
+        util_error(function, t)
+        abort(400, t)
+    results = []
+    for n, dataset in result:
+        if isinstance(n, cronbook.Error):
+            util_error(function, n.description)
+            results.append({ 'dataset' : dataset, 'error' : n.description })
+        else:
+            t = str(n) + ' sets added to dataset ' + dataset 
+            util_success(function, t)
+            results.append({ 'dataset' : dataset, 'rows' : n })
+    response.content_type = 'application/json'
+    return json.dumps({ 'results' : results })
+
 @route(g_url_query, method='GET')
 def get_cronbook_query():
     """Return a JSON document based on values matching query parameters"""
    
     function = 'query'
     try:
-        n, output = cronbook.query(request.query.dataset, long(request.query.time_min), long(request.query.time_max))
-        t = str(n) + ' sets returned via query ' + request.query.dataset + ' from ' + request.query.time_min + ' to ' + request.query.time_max 
-        util_success(function, t)
-        if (n == 0):
-            abort(404, 'no results')
-        return output
+        fragments = cronbook.query_iter(request.query.dataset, long(request.query.time_min), long(request.query.time_max))
+        t = ' sets returned via query ' + request.query.dataset + ' from ' + request.query.time_min + ' to ' + request.query.time_max 
+        # read ahead to the first row so that an empty result can still be refused
+        head = fragments.next()
+        first = fragments.next()
+        second = next(fragments, None)
     except ValueError:
         t = 'invalid query'
         util_error(function, t)
@@ -69,29 +151,216 @@ def get_cronbook_query():
         t = 'error' 
         util_error(function, t)
         abort(400, t)
-    return
+    if second is None:
+        util_success(function, '0' + t)
+        abort(404, 'no results')
+    response.content_type = 'application/json'
+    return util_query_stream(function, t, itertools.chain([head, first, second], fragments))
 
 def util_error ( location, message ):
     """Write a short error message"""
 
-    t = cronbook.util_timestamp() + ', ' + location + ': ' + message + '\n'
-    f = open(g_file_server_log, 'a')
-    f.write(t)
-    f.close()
+    cronbook.util_log_write(g_file_server_log, location, message)
+    return
+
+def util_interrupt ( signum, frame ):
+    """Stop serving on SIGTERM as on an interrupt from the keyboard"""
+
+    raise KeyboardInterrupt
+
+def util_query_stream ( location, message, fragments ):
+    """Yield a fragmented JSON document in chunks of about g_query_chunk_size bytes, then write a short success message with the number of rows sent"""
+
+    # fragments are the head of the document, one per row, then the tail; once the first chunk is
+    # sent with the response headers, an error can only end the response early
+    n = -2
+    sent = None
+    chunk = []
+    size = 0
+    try:
+        for x in fragments:
+            n += 1
+            chunk.append(x)
+            size += len(x)
+            if (size >= g_query_chunk_size):
+                yield ''.join(chunk)
+                sent = n + 1
+                chunk = []
+                size = 0
+    except cronbook.Error as e:
+        t = e.description
+    except Exception:
+        t = 'error'
+    else:
+        yield ''.join(chunk)
+        util_success(location, str(n) + message)
+        return
+    if sent is None:
+        util_error(location, t)
+        abort(500, t)
+    util_error(location, t + ', response ended after ' + str(sent) + ' sets')
+    return
+
+def util_retention ( ):
+    """Run retention every g_retention_interval seconds for as long as the server runs"""
+
+    while True:
+        cronbook.util_retention_run()
+        time.sleep(cronbook.g_retention_interval)
+
+def util_serve ( server ):
+    """Serve requests with g_threads threads until interrupted"""
+
+    # without workers there is no daemon writer to run retention, so a thread of its own does
+    server.requests = Queue.Queue(g_threads_queue)
+    t = threading.Thread(target=util_retention)
+    t.daemon = True
+    t.start()
+    for i in range(max(g_threads, 1)):
+        t = threading.Thread(target=util_thread, args=(server,))
+        t.daemon = True
+        t.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        raise
     return
 
 def util_success ( location, message ):
     """Write a short success message"""
 
-    t = cronbook.util_timestamp() + ', ' + location + ': ' + message + '\n'
-    f = open(g_file_server_log, 'a')
-    f.write(t)
-    f.close()
+    cronbook.util_log_write(g_file_server_log, location, message)
+    return
+
+def util_thread ( server ):
+    """Serve queued requests for as long as the server runs"""
+
+    while True:
+        connection, client_address = server.requests.get()
+        try:
+            server.finish_request(connection, client_address)
+        except:
+            server.handle_error(connection, client_address)
+        finally:
+            server.shutdown_request(connection)
+
+def util_worker ( server, owners, number ):
+    """Serve requests in a forked worker, which writes the data sets it owns through its ingest daemon, until interrupted"""
+
+    cronbook.util_log_open(g_file_server_log)
+    owner = owners[number]
+    for x in owners:
+        if x is not owner:
+            x.socket.close()
+    t = threading.Thread(target=cronbook.daemon_write, args=(owner.requests, {}))
+    t.daemon = True
+    t.start()
+    t = threading.Thread(target=owner.serve_forever)
+    t.daemon = True
+    t.start()
+    try:
+        util_serve(server)
+    finally:
+        # a worker is signalled by its process group as well as by the parent, and a further signal must not
+        # interrupt it while it lets the writer finish queued requests
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        owner.requests.join()
+        cronbook.util_log_close()
+    return
+
+def util_worker_add ( data ):
+    """Forward JSON string to the worker which owns its data set.  Returns number of rows and data set"""
+
+    try:
+        name = json.loads(data, strict=False)['dataset']
+    except (ValueError, KeyError, TypeError):
+        raise cronbook.BadJsonError(data)
+    if not isinstance(name, basestring):
+        raise cronbook.BadJsonError(data)
+    address = util_worker_socket(util_worker_number(name))
+    s = cronbook.util_daemon_connect(address)
+    if s is None:
+        raise cronbook.NetworkError(address)
+    return cronbook.util_daemon_send(s, address, data)
+
+def util_worker_add_lines ( lines ):
+    """Forward newline-delimited JSON strings, one document per data set, to the workers which own the data sets.  Returns list of (rows, name), where rows is an Error for a data set not added"""
+
+    # the owner adds the timestamp again from the unix time; each data set is forwarded whether or not others fail,
+    # as cronbook.add_lines does
+    result = []
+    for name, keys, values in cronbook.util_lines_prepare(lines):
+        t = { 'dataset' : name, 'keys' : keys[:1] + keys[2:], 'values' : [x[:1] + x[2:] for x in values] }
+        try:
+            result.append((util_worker_add(json.dumps(t))[0], name))
+        except cronbook.Error as e:
+            result.append((e, name))
+    return result
+
+def util_worker_number ( name ):
+    """Returns the number of the worker which owns a data set"""
+
+    # crc32 rather than hash, so that every worker, and every start of the server, agrees
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return (zlib.crc32(name) & 0xffffffff) % g_workers
+
+def util_worker_socket ( number ):
+    """Returns the unix socket of the ingest daemon of a worker"""
+
+    return g_workers_socket + str(number)
+
+def util_workers ( server ):
+    """Fork g_workers workers which serve requests from one listening socket, and wait for them until interrupted"""
+
+    # ingest daemons listen before any worker starts, so that no forwarded request finds a worker missing
+    owners = []
+    for i in range(g_workers):
+        address = util_worker_socket(i)
+        if os.path.exists(address):
+            os.remove(address)
+        owners.append(cronbook.daemon_server(address))
+    # the log writer thread does not survive fork, so every process starts its own
+    cronbook.util_log_close()
+    pids = []
+    for i in range(g_workers):
+        pid = os.fork()
+        if (pid == 0):
+            # a worker never returns into the code of the parent, however it is interrupted
+            try:
+                util_worker(server, owners, i)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    cronbook.util_log_open(g_file_server_log)
+
+    reaped = []
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+            reaped.append(pid)
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for pid in [x for x in pids if x not in reaped]:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        server.server_close()
+        for x in owners:
+            x.server_close()
+            os.remove(x.server_address)
     return
 
 
 # pre-server init
 function = 'main'
+cronbook.util_log_open(g_file_server_log)
+signal.signal(signal.SIGTERM, util_interrupt)
 pid = str(os.getpid())
 f = open(g_file_server_pid, 'w')
 f.write(pid)
@@ -99,9 +368,18 @@ f.close()
 util_success(function, 'server started as pid ' + pid)
 
 # server init
-run(host=g_host, port=g_port, quiet=True)
+if (g_workers > 0):
+    # data sets are written by their owner worker only, queries are answered by any worker
+    run(host=g_host, port=g_port, quiet=True, server=PoolServerAdapter)
+elif (g_threads > 0):
+    # appends to one data set are serialised, appends to different data sets and queries run at once
+    cronbook.g_dataset_locks = {}
+    run(host=g_host, port=g_port, quiet=True, server=PoolServerAdapter)
+else:
+    run(host=g_host, port=g_port, quiet=True)
 
 # post-server init
 os.remove(g_file_server_pid)
 util_success(function, 'server stopped')
+cronbook.util_log_close()
 sys.exit(0)
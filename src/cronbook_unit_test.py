@@ -6,8 +6,13 @@
 # This script tests the utility and data set oriented functions of cronbook.py
 # ------------------------------------------------------------------------------
 
+from datetime import datetime
 import os
+import shutil
+import sys
 import tempfile
+import threading
+import time
 import cronbook
 import unittest
 
@@ -19,6 +24,20 @@ class TestUtilityFunctions(unittest.TestCase):
     def tearDown(self):
         return
 
+    def test_util_fragments_write(self):
+
+        t = tempfile.TemporaryFile()
+        fragments_1 = iter(['{ "values": [ ', ' ] }'])
+        fragments_2 = iter(['{ "values": [ ', '["1"]', ', ["2"]', ' ] }'])
+
+        self.assertEqual( cronbook.util_fragments_write(t, fragments_1), 0 )
+        self.assertEqual( t.tell(), 0 )
+        self.assertEqual( cronbook.util_fragments_write(t, fragments_2), 2 )
+        t.seek(0)
+        self.assertEqual( t.read(), '{ "values": [ ["1"], ["2"] ] }\n' )
+
+        t.close()
+
     def test_util_is_int(self):
 
         s_bad_1 = ''
@@ -68,6 +87,10 @@ class TestUtilityFunctions(unittest.TestCase):
         json_bad_10 = '{ "dataset" : "", "keys" : ["key_1"], "values" : [ [ "value_1" ] ] }'
         json_bad_11 = '{ "dataset" : " ", "keys" : ["key_1"], "values" : [ [ "value_1" ] ] }'
 
+        # incorrect no of elements in a later row, or no rows
+        json_bad_12 = '{ "dataset" : "test", "keys" : ["key_1"], "values" : [ [ "value_1" ], [ "value_1", "value_2" ] ] }'
+        json_bad_13 = '{ "dataset" : "test", "keys" : ["key_1"], "values" : [ ] }'
+
         json_good = '{ "dataset" : "test", "keys" : ["key_1"], "values" : [ [ "value_1" ] ] }'
 
         self.assertTrue( cronbook.util_json_bad(json_bad_1) )
@@ -81,6 +104,8 @@ class TestUtilityFunctions(unittest.TestCase):
         self.assertTrue( cronbook.util_json_bad(json_bad_9) )
         self.assertTrue( cronbook.util_json_bad(json_bad_10) )
         self.assertTrue( cronbook.util_json_bad(json_bad_11) )
+        self.assertTrue( cronbook.util_json_bad(json_bad_12) )
+        self.assertTrue( cronbook.util_json_bad(json_bad_13) )
         self.assertFalse( cronbook.util_json_bad(json_good) )
 
     def test_util_key_bad(self):
@@ -146,11 +171,96 @@ class TestUtilityFunctions(unittest.TestCase):
         self.assertEqual(keys, keys_new)
         self.assertEqual(values, values_new)
 
+    def test_util_log(self):
+
+        path = tempfile.mkdtemp()
+        fname = os.path.join(path, 'log')
+        settings = [cronbook.g_log_size, cronbook.g_log_rotate_max, cronbook.g_log_flush_interval]
+        try:
+            # messages are written by the log writer, in order, by the time it is stopped, or directly without one
+            cronbook.util_log_write(fname, 'test', 'message 0')
+            cronbook.util_log_open(fname)
+            self.assertEqual( cronbook.g_log[0].maxsize, cronbook.g_log_queue_size )
+            for i in range(1, 3):
+                cronbook.util_log_write(fname, 'test', 'message ' + str(i))
+            cronbook.util_log_close()
+            lines = open(fname).read().splitlines()
+            self.assertEqual( [x.split(', ', 1)[1] for x in lines], ['test: message 0', 'test: message 1', 'test: message 2'] )
+            os.remove(fname)
+
+            # a log which is never idle is still rotated once it has grown past g_log_size
+            cronbook.g_log_flush_interval = 0
+            cronbook.g_log_size = 100
+            cronbook.g_log_rotate_max = 2
+            cronbook.util_log_open(fname)
+            for i in range(3):
+                cronbook.util_log_write(fname, 'test', 'x' * 100)
+            cronbook.util_log_close()
+            self.assertEqual( sorted(os.listdir(path)), ['log', 'log.1', 'log.2'] )
+            for x in os.listdir(path):
+                os.remove(os.path.join(path, x))
+
+            # the log is renamed once it has grown past g_log_size, keeping at most g_log_rotate_max old logs
+            f = open(fname, 'a')
+            for i in range(3):
+                f.write('x' * 100 + '\n')
+                f.flush()
+                f = cronbook.util_log_rotate(f, fname)
+            f.close()
+            self.assertEqual( sorted(os.listdir(path)), ['log', 'log.1', 'log.2'] )
+            self.assertEqual( os.path.getsize(fname), 0 )
+        finally:
+            cronbook.util_log_close()
+            cronbook.g_log_size, cronbook.g_log_rotate_max, cronbook.g_log_flush_interval = settings
+            shutil.rmtree(path)
+
+    def test_util_schema_line(self):
+
+        schema = ['unixtime', 'timestamp', 'key_1']
+        self.assertEqual( cronbook.util_schema_line(schema, 0), 'unixtime|timestamp|key_1\n' )
+        self.assertEqual( cronbook.util_schema_line(schema, 1), 'unixtime|timestamp|key_1|\n' )
+        self.assertEqual( cronbook.util_schema_line(schema, 4), 'unixtime|timestamp|key_1|   \n' )
+
     # uncertain how to test these
     #def test_util_timestamp(self):
-    #def test_util_timestamp_format(self):
     #def test_util_timestamp_unix(self):
 
+    def test_util_timestamp_format(self):
+
+        unixtimes = ['1459807807736918', '1459807807000001', '1459807808999999', '1459807807736918', 1459807807736918L]
+        g_timestamp_cache_size = cronbook.g_timestamp_cache_size
+        cronbook.g_timestamp_cache_size = 2
+
+        for x in unixtimes:
+            t = datetime.fromtimestamp(float(x) / 1000000).strftime('%Y-%m-%d %H:%M:%S.%f') + ' ' + time.strftime('%Z')
+            self.assertEqual( cronbook.util_timestamp_format(x), t )
+        self.assertTrue( len(cronbook.g_timestamp_cache) <= 2 )
+
+        # threads formatting different seconds at once each get the time stamp of their own second
+        seconds = [1459810810 + x for x in range(8)]
+        expected = dict([(x, datetime.fromtimestamp(x).strftime('%Y-%m-%d %H:%M:%S')) for x in seconds])
+        wrong = []
+        def formatter(i):
+            for j in range(20000):
+                x = seconds[(i + j) % len(seconds)]
+                if not cronbook.util_timestamp_format(x * 1000000 + 5).startswith(expected[x] + '.'):
+                    wrong.append(x)
+        threads = [threading.Thread(target=formatter, args=(i,)) for i in range(4)]
+        # switch threads as often as possible, so that races show
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertEqual( wrong, [] )
+        self.assertTrue( len(cronbook.g_timestamp_cache) <= 2 )
+
+        cronbook.g_timestamp_cache_size = g_timestamp_cache_size
+
     def test_util_values_clean(self):
 
         before_escape_1 = ['embedded 	tab']
@@ -162,7 +272,14 @@ class TestUtilityFunctions(unittest.TestCase):
 
         self.assertEqual( cronbook.util_values_clean(before_escape_1), after_escape_1)
         self.assertEqual( cronbook.util_values_clean(before_escape_2), after_escape_2)
+        before_utf8_2 = [u'caf\xe9', 'caf\xc3\xa9\xc3']
+        after_utf8_2 = ['caf\xc3\xa9', 'caf\xc3\xa9']
+        before_ascii_1 = ['0.67', u'98.93', 'myhost']
+        after_ascii_1 = ['0.67', '98.93', 'myhost']
+
         self.assertEqual( cronbook.util_values_clean(before_utf8_1), after_utf8_1)
+        self.assertEqual( cronbook.util_values_clean(before_utf8_2), after_utf8_2)
+        self.assertEqual( cronbook.util_values_clean(before_ascii_1), after_ascii_1)
 
     def test_util_values_order(self):
 
@@ -175,6 +292,20 @@ class TestUtilityFunctions(unittest.TestCase):
 
         self.assertEqual(values_ordered, t)
 
+    def test_util_values_mapper(self):
+
+        schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1', 'key_2', 'key_3']
+        keys = ['key_2', cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+        values = [['value_2', '0', 'timestamp_0', 'value_1'], ['value_4', '1', 'timestamp_1', 'value_3']]
+        values_ordered = [['0', 'timestamp_0', 'value_1', 'value_2', ''], ['1', 'timestamp_1', 'value_3', 'value_4', '']]
+
+        order = cronbook.util_values_mapper(schema, keys)
+
+        self.assertEqual([order(x) for x in values], values_ordered)
+        self.assertEqual(cronbook.util_values_mapper(keys, keys)(values[0]), values[0])
+        self.assertEqual(cronbook.util_values_mapper(['key_1'], keys)(values[0]), ['value_1'])
+        self.assertEqual(cronbook.util_values_mapper(['key_4'], keys)(values[0]), [''])
+
 
 class TestDatasetFunctions(unittest.TestCase):
 
@@ -184,12 +315,96 @@ class TestDatasetFunctions(unittest.TestCase):
     def tearDown(self):
         return
 
+    def test_ds_compact(self):
+
+        path = tempfile.mkdtemp()
+        g_compact_rows = cronbook.g_compact_rows
+        g_rotate_policies = cronbook.g_rotate_policies
+        cronbook.g_compact_rows = 2
+        cronbook.g_rotate_policies = { 'test' : { 'rows' : 3 } }
+        fname = path + '/test'
+
+        schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+        keys = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_2']
+        values = [[str(x), cronbook.util_timestamp_format(x), 'value_' + str(x)] for x in [5, 3, 3, 1, 4]]
+        values_2 = [['2', cronbook.util_timestamp_format(2), 'value_2']]
+        rows = [['1', cronbook.util_timestamp_format(1), 'value_1', ''], ['2', cronbook.util_timestamp_format(2), '', 'value_2'], ['3', cronbook.util_timestamp_format(3), 'value_3', ''], ['4', cronbook.util_timestamp_format(4), 'value_4', ''], ['5', cronbook.util_timestamp_format(5), 'value_5', '']]
+
+        t = cronbook.ds_open(fname, schema)
+        for x in values:
+            cronbook.ds_rotate(t, 'test', None)
+            cronbook.ds_write(t, schema, [x])
+        cronbook.ds_rotate(t, 'test', None)
+        cronbook.ds_write(t, keys, values_2)
+        cronbook.ds_rotate(t, 'test', None)
+        t.close()
+        segments = cronbook.ds_segments(fname)
+        self.assertEqual( len(segments), 2 )
+
+        # the first output file reaches the size limit with its second row
+        size = len(cronbook.util_schema_line(schema + ['key_2'], cronbook.g_schema_reserve)) + 50
+        self.assertEqual( cronbook.ds_compact(fname, size, True), 5 )
+        self.assertEqual( [x[1:] for x in cronbook.ds_manifest_read(fname)], [[1, 2, True], [3, 4, True], [5, 5, True]] )
+        self.assertEqual( [os.path.isfile(x) for x in segments], [False, False] )
+        self.assertEqual( sorted([x for x in os.listdir(path) if 'compact' in x]), [] )
+
+        t = open(fname, 'r')
+        self.assertEqual( list(cronbook.ds_query_segments(t, 0, 9)), rows )
+        t.close()
+        t = open(cronbook.ds_segments(fname)[0], 'r')
+        self.assertEqual( list(cronbook.ds_query_rows(t, 0, 9, True)), rows[:2] )
+        t.close()
+
+        cronbook.g_compact_rows = g_compact_rows
+        cronbook.g_rotate_policies = g_rotate_policies
+        shutil.rmtree(path)
+
+    def test_ds_compress(self):
+
+        path = tempfile.mkdtemp()
+        g_rotate_compress = cronbook.g_rotate_compress
+        g_rotate_size = cronbook.g_rotate_size
+        cronbook.g_rotate_size = 1
+        fname = path + '/test'
+
+        schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+        values = [[str(x), cronbook.util_timestamp_format(x), 'value_' + str(x)] for x in range(0, 3)]
+
+        for x, compress in zip(values, ['.bz2', '.gz', '']):
+            cronbook.g_rotate_compress = compress
+            t = cronbook.ds_open(fname, schema)
+            cronbook.ds_write(t, schema, [x])
+            cronbook.ds_rotate(t, 'test', None)
+            t.close()
+        cronbook.ds_compress(fname + '.3.2', '.bz2')
+
+        # the first two files are compressed in the background
+        for i in range(500):
+            if not (os.path.isfile(fname + '.1.0') or os.path.isfile(fname + '.2.1')):
+                break
+            time.sleep(0.01)
+
+        self.assertEqual( cronbook.ds_segments(fname), [fname + '.1.0.bz2', fname + '.2.1.gz', fname + '.3.2.bz2'] )
+        self.assertEqual( sorted(os.listdir(path)), ['test', 'test.1.0.bz2', 'test.2.1.gz', 'test.3.2.bz2', 'test.manifest'] )
+
+        t = open(fname, 'r')
+        self.assertEqual( list(cronbook.ds_query_segments(t, 0, 9)), values )
+        self.assertEqual( list(cronbook.ds_query_segments(t, 1, 1)), values[1:2] )
+        t.close()
+
+        with self.assertRaises(cronbook.DiskError):
+            cronbook.ds_compress(fname + '.4', '.gz')
+
+        cronbook.g_rotate_compress = g_rotate_compress
+        cronbook.g_rotate_size = g_rotate_size
+        shutil.rmtree(path)
+
     def test_ds_create(self):
 
         t = tempfile.NamedTemporaryFile()
 
         schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1', 'key_2']
-        schema_representation = 'unixtime|timestamp|key_1|key_2\n'
+        schema_representation = 'unixtime|timestamp|key_1|key_2|' + ' ' * (cronbook.g_schema_reserve - 1) + '\n'
 
         cronbook.ds_create(t, schema)
         t.seek(0)
@@ -215,7 +430,107 @@ class TestDatasetFunctions(unittest.TestCase):
         
         self.assertEqual( fname, cronbook.ds_filename(name) )
 
-    #def test_ds_query(self):
+    def test_ds_index_update(self):
+
+        t = tempfile.NamedTemporaryFile()
+        g_index_size = cronbook.g_index_size
+        cronbook.g_index_size = 100
+
+        schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+        keys = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+        values = [[str(x), cronbook.util_timestamp_format(x), 'value_' + str(x)] for x in range(0, 100, 10)]
+
+        cronbook.ds_create(t, schema)
+        cronbook.ds_write(t, keys, values)
+
+        index = cronbook.ds_index_read(t)
+        t.seek(0, 2)
+        size = t.tell()
+
+        self.assertTrue( len(index) > 1 )
+        self.assertEqual( index[0][0], len(cronbook.util_schema_line(schema, cronbook.g_schema_reserve)) )
+        for i in range(1, len(index)):
+            self.assertEqual( index[i][0], index[i-1][1] )
+        self.assertTrue( (size - index[-1][1]) < cronbook.g_index_size )
+        self.assertEqual( cronbook.ds_index_update(t, False), 0 )
+
+        cronbook.ds_index_update(t, True)
+        index = cronbook.ds_index_read(t)
+
+        self.assertEqual( index[-1][1], size )
+        self.assertEqual( sum(x[2] for x in index), len(values) )
+        self.assertEqual( (index[0][3], index[-1][4]), (0, 90) )
+
+        cronbook.g_index_size = g_index_size
+        os.remove(cronbook.ds_index_filename(t.name))
+        t.close()
+
+    def test_ds_query(self):
+
+        t = tempfile.NamedTemporaryFile()
+
+        schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+        keys = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+        values = [[str(x), cronbook.util_timestamp_format(x), 'value_' + str(x)] for x in range(0, 100, 10)]
+        values_unordered = [[str(x), cronbook.util_timestamp_format(x), 'value_' + str(x)] for x in [50, 10, 90, 30, 70]]
+        json_representation = '{ "dataset": "test", "keys": ["unixtime", "timestamp", "key_1"], "values": [ ["30", "' + cronbook.util_timestamp_format(30) + '", "value_30"], ["40", "' + cronbook.util_timestamp_format(40) + '", "value_40"] ] }'
+        json_representation_unordered = '{ "dataset": "test", "keys": ["unixtime", "key_1"], "values": [ ["50", "value_50"], ["30", "value_30"] ] }'
+
+        cronbook.ds_create(t, schema)
+        cronbook.ds_write(t, keys, values)
+
+        self.assertEqual( cronbook.ds_query(t, 'test', 25, 45, True), (2, json_representation) )
+        self.assertEqual( cronbook.ds_query(t, 'test', 91, 95, True)[0], 0 )
+        self.assertEqual( len(list(cronbook.ds_query_iter(t, 'test', 25, 45, True))), 2 + 2 )
+
+        g_index_size = cronbook.g_index_size
+        cronbook.g_index_size = 100
+        cronbook.ds_index_build(t)
+
+        self.assertEqual( cronbook.ds_query(t, 'test', 25, 45, True), (2, json_representation) )
+        self.assertEqual( cronbook.ds_query(t, 'test', 0, 90, True)[0], len(values) )
+
+        cronbook.g_index_size = g_index_size
+        os.remove(cronbook.ds_index_filename(t.name))
+        t.close()
+
+        t = tempfile.NamedTemporaryFile()
+
+        cronbook.ds_create(t, schema)
+        cronbook.ds_write(t, keys, values_unordered)
+
+        self.assertEqual( cronbook.ds_query(t, 'test', 25, 55, False), (2, json_representation_unordered) )
+
+        t.close()
+
+        with self.assertRaises(cronbook.DiskError):
+            cronbook.ds_query(t, 'test', 25, 55, False)
+
+    def test_ds_query_segments(self):
+
+        t = tempfile.NamedTemporaryFile()
+        t_1 = open(t.name + '.1', 'w+')
+
+        schema_1 = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+        schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1', 'key_2']
+        values_1 = [[str(x), cronbook.util_timestamp_format(x), 'value_1'] for x in [10, 20]]
+        values = [[str(x), cronbook.util_timestamp_format(x), 'value_1', 'value_2'] for x in [30, 40]]
+        rows = [['20', cronbook.util_timestamp_format(20), 'value_1', ''], ['30', cronbook.util_timestamp_format(30), 'value_1', 'value_2']]
+
+        cronbook.ds_create(t_1, schema_1)
+        cronbook.ds_write(t_1, schema_1, values_1)
+        cronbook.ds_create(t, schema)
+        cronbook.ds_write(t, schema, values)
+
+        self.assertEqual( cronbook.ds_segments(t.name), [t_1.name] )
+        self.assertEqual( cronbook.ds_segment_range(t_1, True), (10, 20) )
+        self.assertEqual( cronbook.ds_segment_range(t_1, False), None )
+        self.assertEqual( list(cronbook.ds_query_segments(t, 15, 35)), rows )
+        self.assertEqual( list(cronbook.ds_query_segments(t, 25, 35)), rows[1:] )
+
+        t_1.close()
+        os.remove(t_1.name)
+        t.close()
 
     def test_ds_rename(self):
 
@@ -228,13 +543,105 @@ class TestDatasetFunctions(unittest.TestCase):
         t.close()
         os.remove(fname_to)
  
+    def test_ds_rotate(self):
+
+        path = tempfile.mkdtemp()
+        g_file_path_root = cronbook.g_file_path_root
+        g_rotate_max = cronbook.g_rotate_max
+        g_rotate_size = cronbook.g_rotate_size
+        cronbook.g_file_path_root = path + '/'
+        cronbook.g_rotate_max = 2
+        cronbook.g_rotate_size = 1
+        fname = cronbook.ds_filename('test')
+
+        schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+
+        # a rotated file from before the manifest is kept as the oldest
+        t = open(fname + '.1', 'w')
+        cronbook.ds_create(t, schema)
+        cronbook.ds_row_write(t, ['0', cronbook.util_timestamp_format(0), 'value_0'])
+        t.close()
+
+        for x in range(1, 4):
+            t = cronbook.ds_open(fname, schema)
+            cronbook.ds_write(t, schema, [[str(x), cronbook.util_timestamp_format(x), 'value_' + str(x)]])
+            cronbook.ds_rotate(t, 'test', None)
+            t.close()
+
+        # nothing is rotated below the rotation size
+        cronbook.g_rotate_size = 1048576
+        t = cronbook.ds_open(fname, schema)
+        self.assertEqual( cronbook.ds_rotate(t, 'test', None), os.path.getsize(fname) )
+        t.close()
+
+        self.assertEqual( cronbook.ds_manifest_read(fname), [['3.2', 2, 2, False], ['4.3', 3, 3, False]] )
+        self.assertEqual( cronbook.ds_segments(fname), [fname + '.3.2', fname + '.4.3'] )
+        self.assertEqual( sorted(os.listdir(path)), ['test', 'test.3.2', 'test.3.2.idx', 'test.4.3', 'test.4.3.idx', 'test.manifest'] )
+
+        t = open(fname, 'r')
+        self.assertEqual( [x[0] for x in cronbook.ds_query_segments(t, 0, 9)], ['2', '3'] )
+        t.close()
+
+        cronbook.g_file_path_root = g_file_path_root
+        cronbook.g_rotate_max = g_rotate_max
+        cronbook.g_rotate_size = g_rotate_size
+        shutil.rmtree(path)
+
+    def test_ds_rotate_policy(self):
+
+        path = tempfile.mkdtemp()
+        g_rotate_policies = cronbook.g_rotate_policies
+        fname = path + '/test'
+
+        schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+        now = cronbook.util_timestamp_unix()
+        t = cronbook.ds_open(fname, schema)
+
+        # every 2 rows
+        cronbook.g_rotate_policies = { 'test' : { 'size' : 0, 'rows' : 2 } }
+        cronbook.ds_write(t, schema, [['0', cronbook.util_timestamp_format(0), 'value_0']])
+        cronbook.ds_rotate(t, 'test', None)
+        self.assertEqual( cronbook.ds_row_count(t), 1 )
+        cronbook.ds_write(t, schema, [['1', cronbook.util_timestamp_format(1), 'value_1']])
+        cronbook.ds_rotate(t, 'test', None)
+        self.assertEqual( cronbook.ds_row_count(t), 0 )
+        self.assertEqual( cronbook.ds_segments(fname), [fname + '.1.0'] )
+
+        # hourly, where the first row is from an earlier hour
+        cronbook.g_rotate_policies = { 'test' : { 'size' : 0, 'interval' : 3600 } }
+        cronbook.ds_rotate(t, 'test', 2)
+        cronbook.ds_write(t, schema, [['2', cronbook.util_timestamp_format(2), 'value_2']])
+        cronbook.ds_rotate(t, 'test', now)
+        cronbook.ds_write(t, schema, [[now, cronbook.util_timestamp_format(now), 'value_3']])
+        cronbook.ds_rotate(t, 'test', now)
+        self.assertEqual( cronbook.ds_segments(fname), [fname + '.1.0', fname + '.2.2'] )
+        self.assertEqual( cronbook.ds_row_count(t), 1 )
+
+        # hourly, where rows of an earlier hour are added twice, as copied or backfilled rows are
+        cronbook.g_rotate_policies = { 'old' : { 'size' : 0, 'interval' : 3600 } }
+        g_file_path_root = cronbook.g_file_path_root
+        cronbook.g_file_path_root = path + '/'
+        try:
+            for x in range(2):
+                cronbook.add_document({ 'dataset' : 'old', 'keys' : ['unixtime', 'key_1'], 'values' : [[str(1000000 * x), 'value_' + str(x)]] })
+            t2 = open(cronbook.ds_filename('old'), 'r')
+            self.assertEqual( cronbook.ds_segments(t2.name), [] )
+            self.assertEqual( cronbook.ds_row_count(t2), 2 )
+            t2.close()
+        finally:
+            cronbook.g_file_path_root = g_file_path_root
+
+        t.close()
+        cronbook.g_rotate_policies = g_rotate_policies
+        shutil.rmtree(path)
+
     def test_ds_row_write(self):
 
         t = tempfile.NamedTemporaryFile()
 
         schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1', 'key_2']
         values = ['0', cronbook.util_timestamp_format(0), 'value_1', 'value_2']
-        file_representation = 'unixtime|timestamp|key_1|key_2\n0|' + cronbook.util_timestamp_format(0) + '|value_1|value_2\n'
+        file_representation = cronbook.util_schema_line(schema, cronbook.g_schema_reserve) + '0|' + cronbook.util_timestamp_format(0) + '|value_1|value_2\n'
 
         cronbook.ds_create(t, schema)
         cronbook.ds_row_write(t, values)
@@ -249,6 +656,50 @@ class TestDatasetFunctions(unittest.TestCase):
         with self.assertRaises(cronbook.DiskError):
             cronbook.ds_row_write(t, values)
 
+    def test_ds_seek(self):
+
+        t = tempfile.NamedTemporaryFile()
+
+        schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+        keys = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+        values = [[str(x), cronbook.util_timestamp_format(x), 'value_' + str(x)] for x in range(0, 100, 10)]
+        values_unordered = [[str(x), cronbook.util_timestamp_format(x), 'value_' + str(x)] for x in [50, 10, 90, 30, 70]]
+
+        cronbook.ds_create(t, schema)
+        cronbook.ds_write(t, keys, values)
+
+        for begin in [0, 25, 30, 95]:
+            offset = cronbook.ds_seek(t, begin)
+            t.seek(0)
+            lines = t.readlines()
+            expected = len(lines[0]) + sum(len(x) for x in lines[1:] if cronbook.util_row_unixtime(x) < begin)
+            self.assertEqual(offset, expected)
+
+        t.close()
+
+        t = tempfile.NamedTemporaryFile()
+
+        cronbook.ds_create(t, schema)
+        cronbook.ds_write(t, keys, values_unordered)
+
+        self.assertEqual( cronbook.ds_seek(t, 60), None )
+
+        t.close()
+
+        # a pair written out of order just before the target is not seen by bisection, so is only found by a scan
+        t = tempfile.NamedTemporaryFile()
+
+        unixtimes = range(1000, 2000)
+        unixtimes[500:502] = [1501, 1500]
+        values_pair = [[str(x), cronbook.util_timestamp_format(x), 'value_' + str(x)] for x in unixtimes]
+        cronbook.ds_create(t, schema)
+        cronbook.ds_write(t, keys, values_pair)
+
+        self.assertEqual( [x[0] for x in cronbook.ds_query_rows(t, 1500, 1500, False)], ['1500'] )
+        self.assertEqual( sorted([x[0] for x in cronbook.ds_query_rows(t, 1499, 1500, False)]), ['1499', '1500'] )
+
+        t.close()
+
     def test_ds_schema_modify(self):
 
         t = tempfile.NamedTemporaryFile()
@@ -256,7 +707,8 @@ class TestDatasetFunctions(unittest.TestCase):
         schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1', 'key_2']
         values = ['0', cronbook.util_timestamp_format(0), 'value_1', 'value_2']
         new_keys = ['key_3', 'key_4']
-        file_representation = 'unixtime|timestamp|key_1|key_2|key_3|key_4\n0|' + cronbook.util_timestamp_format(0) + '|value_1|value_2||\n'
+        row_representation = '0|' + cronbook.util_timestamp_format(0) + '|value_1|value_2\n'
+        file_representation = cronbook.util_schema_line(schema + new_keys, cronbook.g_schema_reserve - 12) + row_representation
 
         cronbook.ds_create(t, schema)
         cronbook.ds_row_write(t, values)
@@ -266,15 +718,60 @@ class TestDatasetFunctions(unittest.TestCase):
         content = t.read()
 
         self.assertEqual(file_representation, content)
+        self.assertEqual( cronbook.ds_query(t, 'test', 0, 0, True), (1, '{ "dataset": "test", "keys": ["unixtime", "timestamp", "key_1", "key_2", "key_3", "key_4"], "values": [ ["0", "' + cronbook.util_timestamp_format(0) + '", "value_1", "value_2", "", ""] ] }') )
+
+        # keys already in the schema are not added again
+        cronbook.ds_schema_modify(t, new_keys)
+        t.seek(0)
+        self.assertEqual(file_representation, t.read())
 
         t.close()
 
-        file_exists = os.path.isfile(cronbook.g_file_temporary)
-        self.assertEqual(file_exists, False)
+        # a schema without padding is grown by moving rows once
+        t = tempfile.NamedTemporaryFile()
+        t.write(cronbook.util_schema_line(schema, 0) + row_representation * 3)
+        cronbook.ds_schema_modify(t, new_keys)
+
+        t.seek(0)
+        content = t.read()
+
+        self.assertEqual(cronbook.util_schema_line(schema + new_keys, cronbook.g_schema_reserve) + row_representation * 3, content)
+
+        t.close()
 
         with self.assertRaises(cronbook.DiskError):
             cronbook.ds_schema_modify(t, new_keys)
 
+    def test_ds_schema_modify_segment(self):
+
+        path = tempfile.mkdtemp()
+        g_schema_evolution = cronbook.g_schema_evolution
+        cronbook.g_schema_evolution = 'segment'
+        fname = path + '/test'
+
+        schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+        keys = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_2']
+        values_1 = [['0', cronbook.util_timestamp_format(0), 'value_1']]
+        values_2 = [['1', cronbook.util_timestamp_format(1), 'value_2']]
+
+        t = cronbook.ds_open(fname, schema)
+        cronbook.ds_write(t, schema, values_1)
+        cronbook.ds_write(t, keys, values_2)
+        cronbook.ds_write(t, keys, values_2)
+        t.close()
+
+        # the first segment is left as written, and the open file follows the data set to its new file
+        t = open(fname + '.1.0', 'r')
+        self.assertEqual( cronbook.ds_schema_read(t), schema )
+        t.close()
+        t = open(fname, 'r')
+        self.assertEqual( cronbook.ds_schema_read(t), schema + ['key_2'] )
+        self.assertEqual( cronbook.ds_query(t, 'test', 0, 1, False)[1], '{ "dataset": "test", "keys": ["unixtime", "key_1", "key_2"], "values": [ ["0", "value_1", ""], ["1", "", "value_2"], ["1", "", "value_2"] ] }' )
+        t.close()
+
+        cronbook.g_schema_evolution = g_schema_evolution
+        shutil.rmtree(path)
+
     def test_ds_schema_read(self):
 
         t = tempfile.NamedTemporaryFile()
@@ -299,7 +796,7 @@ class TestDatasetFunctions(unittest.TestCase):
         schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1', 'key_2']
         keys = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1', 'key_2']
         values = [['0', cronbook.util_timestamp_format(0), 'value_1', 'value_2']]
-        file_representation = 'unixtime|timestamp|key_1|key_2\n0|' + cronbook.util_timestamp_format(0) + '|value_1|value_2\n'
+        file_representation = cronbook.util_schema_line(schema, cronbook.g_schema_reserve) + '0|' + cronbook.util_timestamp_format(0) + '|value_1|value_2\n'
 
         cronbook.ds_create(t, schema)
         cronbook.ds_write(t, keys, values)
@@ -314,5 +811,221 @@ class TestDatasetFunctions(unittest.TestCase):
         with self.assertRaises(cronbook.DiskError):
             cronbook.ds_write(t, keys, values)
 
+    def test_retention(self):
+
+        path = tempfile.mkdtemp()
+        g_file_path_root = cronbook.g_file_path_root
+        g_retention_budget = cronbook.g_retention_budget
+        g_rotate_policies = cronbook.g_rotate_policies
+        cronbook.g_file_path_root = path + '/'
+
+        schema = [cronbook.g_key_name_unixtime, cronbook.g_key_name_timestamp, 'key_1']
+        now = long(cronbook.util_timestamp_unix())
+
+        # three rotated files for each data set, those of data set old from 1970
+        cronbook.g_rotate_policies = { 'new' : { 'rows' : 1 }, 'old' : { 'rows' : 1 } }
+        for name, unixtime in [('old', 0), ('new', now)]:
+            t = cronbook.ds_open(cronbook.ds_filename(name), schema)
+            for x in range(unixtime, unixtime + 4):
+                cronbook.ds_rotate(t, name, None)
+                cronbook.ds_write(t, schema, [[str(x), cronbook.util_timestamp_format(x), 'value_1']])
+            t.close()
+        size = cronbook.ds_segment_stat(cronbook.ds_filename('new') + '.3.' + str(now + 2))[0]
+
+        self.assertEqual( cronbook.retention(), 0 )
+
+        cronbook.g_rotate_policies['old']['age'] = 3600
+        self.assertEqual( cronbook.util_retention_due(), True )
+        self.assertEqual( cronbook.util_retention_due(), False )
+        self.assertEqual( cronbook.retention(), 3 )
+        self.assertEqual( cronbook.ds_segments(cronbook.ds_filename('old')), [] )
+        self.assertEqual( len(cronbook.ds_segments(cronbook.ds_filename('new'))), 3 )
+
+        # the data set files count toward the budget, and the oldest rotated files go first
+        cronbook.g_retention_budget = sum([os.path.getsize(path + '/' + x) for x in ['new', 'new.idx', 'old'] if os.path.isfile(path + '/' + x)]) + size
+        self.assertEqual( cronbook.retention(), 2 )
+        self.assertEqual( cronbook.ds_segments(cronbook.ds_filename('new')), [cronbook.ds_filename('new') + '.3.' + str(now + 2)] )
+
+        cronbook.g_file_path_root = g_file_path_root
+        cronbook.g_retention_budget = g_retention_budget
+        cronbook.g_rotate_policies = g_rotate_policies
+        shutil.rmtree(path)
+
+class TestDaemonFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.g_file_path_root = cronbook.g_file_path_root
+        self.g_daemon_socket = cronbook.g_daemon_socket
+        self.path = tempfile.mkdtemp()
+        cronbook.g_file_path_root = self.path + '/'
+        cronbook.g_daemon_socket = self.path + '/socket'
+        return
+
+    def tearDown(self):
+        cronbook.g_file_path_root = self.g_file_path_root
+        cronbook.g_daemon_socket = self.g_daemon_socket
+        shutil.rmtree(self.path)
+        return
+
+    def test_add_lines(self):
+
+        lines = [
+            '{ "dataset" : "test_1", "keys" : ["unixtime", "key_1"], "values" : [ [ "0", "value_1" ] ] }\n',
+            '\n',
+            '{ "dataset" : "test_2", "keys" : ["unixtime", "key_1"], "values" : [ [ "1", "value_1" ] ] }\n',
+            '{ "dataset" : "test_1", "keys" : ["unixtime", "key_2"], "values" : [ [ "2", "value_2" ], [ "3", "value_3" ] ] }'
+        ]
+        file_representation = cronbook.util_schema_line(['unixtime', 'timestamp', 'key_1', 'key_2'], cronbook.g_schema_reserve) + '0|' + cronbook.util_timestamp_format(0) + '|value_1|\n2|' + cronbook.util_timestamp_format(2) + '||value_2\n3|' + cronbook.util_timestamp_format(3) + '||value_3\n'
+
+        self.assertEqual( cronbook.add_lines(lines), [(3, 'test_1'), (1, 'test_2')] )
+        self.assertEqual( open(cronbook.ds_filename('test_1')).read(), file_representation )
+
+        # nothing is added unless all documents are valid
+        with self.assertRaises(cronbook.BadJsonError):
+            cronbook.add_lines(lines[2:3] + ['{ "dataset" : "test_2" '])
+        self.assertEqual( cronbook.query('test_2', 0, 9)[0], 1 )
+
+        # a data set which cannot be added is reported without keeping others from being added
+        result = cronbook.add_lines(lines[2:3] + ['{ "dataset" : "missing/test_3", "keys" : ["key_1"], "values" : [ [ "value_1" ] ] }'])
+        self.assertEqual( result[0], (1, 'test_2') )
+        self.assertTrue( isinstance(result[1][0], cronbook.DiskError) )
+        self.assertEqual( result[1][1], 'missing/test_3' )
+        self.assertEqual( cronbook.query('test_2', 0, 9)[0], 2 )
+
+    def test_client(self):
+
+        json_1 = '{ "dataset" : "test", "keys" : ["unixtime", "key_1"], "values" : [ [ "0", "value_1" ] ] }'
+        json_2 = '{ "dataset" : "test", "keys" : ["unixtime", "key_2"], "values" : [ [ "1", "value_2" ], [ "2", "value_3" ] ] }'
+        json_bad = '{ "dataset" : "test", "keys" : ["key_1"], "values" : [ [ ] ] }'
+        file_representation = cronbook.util_schema_line(['unixtime', 'timestamp', 'key_1', 'key_2'], cronbook.g_schema_reserve - 6) + '0|' + cronbook.util_timestamp_format(0) + '|value_1\n1|' + cronbook.util_timestamp_format(1) + '||value_2\n2|' + cronbook.util_timestamp_format(2) + '||value_3\n'
+
+        # without a daemon listening, the client adds directly
+        self.assertEqual( cronbook.client(json_1), (1, 'test') )
+
+        server = cronbook.daemon_server(cronbook.g_daemon_socket)
+        writer = threading.Thread(target=cronbook.daemon_write, args=(server.requests, {}))
+        writer.daemon = True
+        writer.start()
+        listener = threading.Thread(target=server.serve_forever)
+        listener.start()
+
+        self.assertEqual( cronbook.client(json_2), (2, 'test') )
+        with self.assertRaises(cronbook.DaemonError):
+            cronbook.client(json_bad)
+
+        server.shutdown()
+        server.server_close()
+        listener.join()
+
+        content = open(cronbook.ds_filename('test')).read()
+
+        self.assertEqual(file_representation, content)
+
+    def test_rename_delete(self):
+
+        g_rotate_policies = cronbook.g_rotate_policies
+        cronbook.g_rotate_policies = { 'a' : { 'size' : 0, 'rows' : 1 } }
+        try:
+            # two rotated files, one of them compressed, and the data set file
+            for x in range(3):
+                cronbook.add_document({ 'dataset' : 'a', 'keys' : ['unixtime', 'key_1'], 'values' : [[str(x), 'value_' + str(x)]] })
+            segments = cronbook.ds_segments(cronbook.ds_filename('a'))
+            self.assertEqual( len(segments), 2 )
+            cronbook.ds_compress(segments[0], '.gz')
+
+            # the history moves with the data set, and a new data set of the old name starts empty
+            cronbook.rename('a', 'b')
+            self.assertEqual( [x for x in os.listdir(self.path) if x.startswith('a')], [] )
+            self.assertEqual( cronbook.query('b', 0, 9)[0], 3 )
+            cronbook.add_document({ 'dataset' : 'a', 'keys' : ['unixtime', 'key_1'], 'values' : [['5', 'value_5']] })
+            self.assertEqual( cronbook.query('a', 0, 9)[0], 1 )
+
+            cronbook.delete('b')
+            self.assertEqual( [x for x in os.listdir(self.path) if x.startswith('b')], [] )
+            cronbook.delete('a')
+            self.assertEqual( [x for x in os.listdir(self.path) if x.startswith('a')], [] )
+        finally:
+            cronbook.g_rotate_policies = g_rotate_policies
+
+class TestConcurrentWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = [cronbook.g_file_path_root, cronbook.g_rotate_max, cronbook.g_rotate_size]
+        self.path = tempfile.mkdtemp()
+        cronbook.g_file_path_root = self.path + '/'
+        cronbook.g_rotate_max = 1000
+        cronbook.g_rotate_size = 16384
+        return
+
+    def tearDown(self):
+        cronbook.g_file_path_root, cronbook.g_rotate_max, cronbook.g_rotate_size = self.settings
+        shutil.rmtree(self.path)
+        return
+
+    def test_add_document(self):
+
+        writers = 4
+        adds = 50
+        rows = 10
+
+        # writers add rows concurrently, rotating and adding a key along the way
+        pids = []
+        for i in range(writers):
+            pid = os.fork()
+            if (pid == 0):
+                try:
+                    for j in range(adds):
+                        keys = ['writer', 'row', 'payload']
+                        if (i == 0) and (j >= adds // 2):
+                            keys.append('extra')
+                        values = [[str(i), str(j * rows + k), 'x' * 100] + ['y'] * (len(keys) - 3) for k in range(rows)]
+                        cronbook.add_document({ 'dataset' : 'test', 'keys' : keys, 'values' : values })
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+        # every row is found exactly once, and whole
+        t = open(cronbook.ds_filename('test'), 'r')
+        schema = cronbook.ds_schema_read(t)
+        found = [(x[2], x[3], x[4]) for x in cronbook.ds_query_segments(t, 0, 9999999999999999)]
+        t.close()
+
+        self.assertEqual( schema, ['unixtime', 'timestamp', 'writer', 'row', 'payload', 'extra'] )
+        self.assertTrue( len(cronbook.ds_segments(cronbook.ds_filename('test'))) > 1 )
+        self.assertEqual( sorted(found), sorted([(str(i), str(j), 'x' * 100) for i in range(writers) for j in range(adds * rows)]) )
+
+    def test_add_document_threads(self):
+
+        writers = 4
+        adds = 50
+        rows = 10
+
+        # threads of one process add rows to two data sets, as the threaded server does
+        cronbook.g_dataset_locks = {}
+        def writer(i):
+            for j in range(adds):
+                values = [[str(i), str(j * rows + k), 'x' * 100] for k in range(rows)]
+                cronbook.add_document({ 'dataset' : 'test_' + str(i % 2), 'keys' : ['writer', 'row', 'payload'], 'values' : values })
+        try:
+            threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            locks = cronbook.g_dataset_locks
+            cronbook.g_dataset_locks = None
+
+        for name in ['test_0', 'test_1']:
+            t = open(cronbook.ds_filename(name), 'r')
+            found = [(x[2], x[3]) for x in cronbook.ds_query_segments(t, 0, 9999999999999999)]
+            t.close()
+            n = int(name[-1])
+            self.assertEqual( sorted(found), sorted([(str(i), str(j)) for i in range(n, writers, 2) for j in range(adds * rows)]) )
+        self.assertEqual( sorted(locks.keys()), ['test_0', 'test_1'] )
+        self.assertEqual( cronbook.util_dataset_lock('test_0'), None )
+
 if __name__ == '__main__':
     unittest.main()